@@ -12,6 +12,7 @@ url="https://github.com/fanout/pysmartfeed",
 license="MIT",
 packages=['smartfeed', 'smartfeed.django', 'smartfeed.django.app'],
 install_requires=["pubcontrol>=2.4.2,<3", "gripcontrol>=3.0.2,<4"],
+extras_require={"zstd": ["zstandard"], "pushpin-stats": ["pyzmq", "tnetstring"]},
 classifiers=[
 	"Topic :: Utilities",
 	"License :: OSI Approved :: MIT License"
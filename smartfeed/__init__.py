@@ -1,4 +1,6 @@
 import copy
+import inspect
+import collections
 from datetime import datetime
 import calendar
 import json
@@ -6,10 +8,38 @@ import uuid
 from base64 import b64encode
 from binascii import crc32
 import atexit
+import zlib
+import time
+import heapq
+import bisect
+import os
+import socket
+import threading
+import Queue
+import httplib
+import urllib
+import urlparse
+import random
 import redis
 import pubcontrol
 import gripcontrol
 
+# optional, for compressed item storage
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# optional, for reading pushpin's stats
+try:
+	import zmq
+except ImportError:
+	zmq = None
+try:
+	import tnetstring
+except ImportError:
+	tnetstring = None
+
 def check_grip_sig(grip_sig_header, config):
 	for entry in config:
 		if 'key' not in entry:
@@ -41,6 +71,19 @@ def decode_id_part(s):
 		n += 1
 	return out
 
+def get_channel(prefix, feed_id, format):
+	return prefix + encode_id_part(feed_id) + '-' + encode_id_part(format)
+
+# hint channels carry no content. subscribers are told to fetch again, which
+#   suits requests whose responses can't be built from a single feed's publish
+def get_hint_channel(prefix, feed_id):
+	return prefix + encode_id_part(feed_id) + '-hint'
+
+# event stream channels carry each publish as a server-sent event whose id
+#   is the item cursor, so clients can resume with Last-Event-ID
+def get_sse_channel(prefix, feed_id):
+	return prefix + encode_id_part(feed_id) + '-sse'
+
 def parse_spec(spec):
 	at = spec.find(':')
 	if at < 1: # index 0 or not found
@@ -57,28 +100,113 @@ def get_accept_format(accept_header):
 		raise ValueError('no supported accept value')
 
 # return (content type, body)
-def create_items_body(bformat, items, total=None, prev_cursor=None, last_cursor=None, formatter=None):
+def create_items_body(bformat, items, total=None, prev_cursor=None, last_cursor=None, formatter=None, deleted_total=None):
 	if bformat == 'atom':
 		# TODO: atom format
 		raise NotImplementedError()
 	elif bformat == 'json':
-		out = dict()
+		out = create_items_body_json(items, total=total, prev_cursor=prev_cursor, last_cursor=last_cursor, formatter=formatter, deleted_total=deleted_total)
+		return ('application/json', json.dumps(out, indent=4) + '\n')
+	else:
+		raise ValueError('Unsupported format: %s' % bformat)
+
+# return the json body as an object, for embedding in other responses
+def create_items_body_json(items, total=None, prev_cursor=None, last_cursor=None, formatter=None, deleted_total=None):
+	out = dict()
+	out_items = list()
+	for i in items:
+		if formatter:
+			out_items.append(formatter.to_format(i, 'json'))
+		else:
+			out_items.append(i) # assume json ready
+	out['items'] = out_items
+	if total is not None:
+		out['total'] = total
+	if deleted_total is not None:
+		out['deleted_total'] = deleted_total
+	if prev_cursor is not None:
+		out['prev_cursor'] = prev_cursor
+	if last_cursor is not None:
+		out['last_cursor'] = last_cursor
+	return out
+
+# return (content type, body iterator). the body is produced incrementally from
+#   a sequence of ItemsResult chunks, with the trailer taken from the last one
+def create_items_body_stream(bformat, results, formatter=None):
+	if bformat == 'atom':
+		# TODO: atom format
+		raise NotImplementedError()
+	elif bformat == 'json':
+		return ('application/json', _items_body_stream_json(results, formatter))
+	else:
+		raise ValueError('Unsupported format: %s' % bformat)
+
+def _items_body_stream_json(results, formatter):
+	yield '{\n    "items": ['
+	first = True
+	last = None
+	for result in results:
 		out_items = list()
-		for i in items:
+		for i in result.items:
 			if formatter:
-				out_items.append(formatter.to_format(i, bformat))
+				out_items.append(json.dumps(formatter.to_format(i, 'json')))
 			else:
-				out_items.append(i) # assume json ready
-		out['items'] = out_items
-		if total is not None:
-			out['total'] = total
-		if prev_cursor is not None:
-			out['prev_cursor'] = prev_cursor
-		if last_cursor is not None:
-			out['last_cursor'] = last_cursor
-		return ('application/json', json.dumps(out, indent=4) + '\n')
+				out_items.append(json.dumps(i)) # assume json ready
+		if out_items:
+			if first:
+				yield '\n        '
+				first = False
+			else:
+				yield ',\n        '
+			yield ',\n        '.join(out_items)
+		last = result
+	yield '\n    ]'
+	if last is not None:
+		if last.total is not None:
+			yield ',\n    "total": %s' % json.dumps(last.total)
+		if last.deleted_total is not None:
+			yield ',\n    "deleted_total": %s' % json.dumps(last.deleted_total)
+		if last.last_cursor is not None:
+			yield ',\n    "last_cursor": %s' % json.dumps(last.last_cursor)
+	yield '\n}\n'
+
+# return the json object of a single item, as sent on streams
+def create_stream_content(item, total, cursor, prev_cursor, formatter=None, deleted_total=None):
+	out = dict()
+	if total is not None:
+		out['total'] = total
+	if deleted_total is not None:
+		out['deleted_total'] = deleted_total
+	if prev_cursor is not None:
+		out['prev_cursor'] = prev_cursor
+	if cursor is not None:
+		out['cursor'] = cursor
+	if formatter:
+		out['item'] = formatter.to_format(item, 'json')
 	else:
-		raise ValueError('Unsupported format: %s' % bformat)
+		out['item'] = item # assume json ready
+	return out
+
+# return a server-sent event. data may not contain newlines
+def create_sse_event(data, id=None, event=None):
+	out = ''
+	if event is not None:
+		out += 'event: %s\n' % event
+	if id is not None:
+		out += 'id: %s\n' % id
+	out += 'data: %s\n\n' % data
+	return out
+
+# gzip-compress a body iterator, yielding compressed data as it is produced
+def gzip_body_stream(body):
+	c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for data in body:
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+		out = c.compress(data)
+		if out:
+			yield out
+	yield c.flush()
 
 def calc_toc_checksum(item_ids):
 	ids = list()
@@ -106,6 +234,10 @@ class FeedDoesNotExist(Exception):
 class ItemDoesNotExist(Exception):
 	pass
 
+# the base has been moved elsewhere, see RedisBaseMover
+class BaseMovedError(Exception):
+	pass
+
 class PositionSpec(object):
 	def __init__(self, type, value):
 		self.type = type
@@ -115,10 +247,18 @@ class ItemsResult(object):
 	def __init__(self):
 		self.items = list()
 		self.total = None
+		self.deleted_total = None
+		# cursor of each item, if requested
+		self.cursors = None
 		self.last_cursor = None
 
+# each configured endpoint is published to by workers PubControl instances,
+#   each sending from its own thread. a channel always goes through the same
+#   one, so its items stay in order
 class PubControlSet(object):
-	def __init__(self):
+	def __init__(self, workers=1):
+		self.workers = workers
+		# list of lists of instances, one list per endpoint
 		self.pubs = list()
 		atexit.register(self._finish)
 
@@ -126,34 +266,46 @@ class PubControlSet(object):
 		self.pubs = list()
 
 	def add(self, pub):
-		self.pubs.append(pub)
+		self.pubs.append([pub])
 
 	def apply_config(self, config):
 		for entry in config:
-			pub = pubcontrol.PubControl(entry['uri'])
-			if 'iss' in entry:
-				pub.set_auth_jwt({'iss': entry['iss']}, entry['key'])
+			group = list()
+			for n in range(self.workers):
+				pub = pubcontrol.PubControl(entry['uri'])
+				if 'iss' in entry:
+					pub.set_auth_jwt({'iss': entry['iss']}, entry['key'])
+				group.append(pub)
 
-			self.pubs.append(pub)
+			self.pubs.append(group)
 
 	def apply_grip_config(self, config):
 		for entry in config:
 			if 'control_uri' not in entry:
 				continue
 
-			pub = pubcontrol.PubControl(entry['control_uri'])
-			if 'control_iss' in entry:
-				pub.set_auth_jwt({'iss': entry['control_iss']}, entry['key'])
+			group = list()
+			for n in range(self.workers):
+				pub = pubcontrol.PubControl(entry['control_uri'])
+				if 'control_iss' in entry:
+					pub.set_auth_jwt({'iss': entry['control_iss']}, entry['key'])
+				group.append(pub)
 
-			self.pubs.append(pub)
+			self.pubs.append(group)
 
 	def publish(self, channel, item):
-		for pub in self.pubs:
-			pub.publish_async(channel, item)
+		# feed ids from urls are unicode
+		if isinstance(channel, unicode):
+			h = crc32(channel.encode('utf-8'))
+		else:
+			h = crc32(channel)
+		for group in self.pubs:
+			group[(h & 0xffffffff) % len(group)].publish_async(channel, item)
 
 	def _finish(self):
-		for pub in self.pubs:
-			pub.finish()
+		for group in self.pubs:
+			for pub in group:
+				pub.finish()
 
 class HttpRequestFormat(pubcontrol.Format):
 	def __init__(self, method=None, headers=None, body=None):
@@ -178,6 +330,15 @@ class HttpRequestFormat(pubcontrol.Format):
 				out['body-bin'] = b64encode(val)
 		return out
 
+class HttpResponseHintFormat(pubcontrol.Format):
+	def name(self):
+		return 'http-response'
+
+	def export(self):
+		out = dict()
+		out['action'] = 'hint'
+		return out
+
 class Formatter(object):
 	def is_supported(self, format):
 		pass
@@ -185,6 +346,28 @@ class Formatter(object):
 	def to_format(self, item, format):
 		pass
 
+# publisher class -> whether its publish accepts deleted_total
+publish_takes_deleted_total = dict()
+
+# deleted_total was added to Publisher.publish later. it is left out for
+#   publishers overriding publish with the earlier signature, so they keep
+#   working
+def call_publish(publisher, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+	cls = type(publisher)
+	takes = publish_takes_deleted_total.get(cls)
+	if takes is None:
+		try:
+			args, varargs, keywords, defaults = inspect.getargspec(cls.publish)
+			takes = ('deleted_total' in args or keywords is not None)
+		except TypeError:
+			# not a python function, assume the current signature
+			takes = True
+		publish_takes_deleted_total[cls] = takes
+	if takes:
+		publisher.publish(feed_id, item, total, cursor, prev_cursor, deleted_total=deleted_total)
+	else:
+		publisher.publish(feed_id, item, total, cursor, prev_cursor)
+
 class Publisher(object):
 	def psh_sub_set(self, feed_id, uri):
 		pass
@@ -198,10 +381,17 @@ class Publisher(object):
 	def xmpp_sub_remove(self, feed_id, jid):
 		pass
 
-	# total may be None
-	def publish(self, feed_id, item, total, cursor, prev_cursor):
+	# total and deleted_total may be None
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
 		pass
 
+	# publish consecutive items of a feed at once. cursors has the cursor of
+	#   each item, and prev_cursor is the one before the first
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		for n, item in enumerate(items):
+			call_publish(self, feed_id, item, total, cursors[n], prev_cursor, deleted_total=deleted_total)
+			prev_cursor = cursors[n]
+
 class Model(object):
 	def __init__(self, publisher=None):
 		self.publisher = publisher
@@ -222,38 +412,213 @@ class Model(object):
 		self.db_xmpp_sub_remove(feed_id, jid)
 		self.publisher.xmpp_sub_remove(feed_id, jid)
 
-	def notify(self, feed_id, item, total, cursor, prev_cursor):
-		self.publisher.publish(feed_id, item, total, cursor, prev_cursor)
+	def notify(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		call_publish(self.publisher, feed_id, item, total, cursor, prev_cursor, deleted_total=deleted_total)
 
-	def get_items(self, feed_id, since_spec, until_spec, max_count):
+	# filters, if set, is a dict of filter names to values. if cursors is
+	#   true, the result includes the cursor of each item. fields, if set, is
+	#   a list of the top-level fields of item data to return
+	def get_items(self, feed_id, since_spec, until_spec, max_count, filters=None, cursors=False, fields=None):
 		raise NotImplementedError('get_items not implemented')
 
+	# queries is a list of (feed_id, since_spec, until_spec, max_count).
+	#   return a list of ItemsResult, one for each query
+	def get_items_batch(self, queries):
+		out = list()
+		for q in queries:
+			out.append(self.get_items(*q))
+		return out
+
+	# return true if cursor is known to be positioned after the last item of
+	#   the feed, so that a query from it would find nothing. false means
+	#   unknown, and the feed must be queried
+	def is_head(self, feed_id, cursor):
+		return False
+
+	# return for each feed a value that changes whenever the feed is written
+	#   to, or None where this isn't known
+	def get_heads(self, feed_ids):
+		return [None] * len(feed_ids)
+
+	# read a single timeline merged from feeds of the same ordering. the
+	#   cursor of the result is a composite of a cursor for each feed
+	def get_merged_items(self, feed_ids, since_spec, until_spec, max_count, filters=None, fields=None):
+		raise NotImplementedError('merged feeds not implemented')
+
+	# generate ItemsResult chunks of up to chunk_size items each, by paging
+	#   with the cursor of the previous chunk, until max_count items are read
+	#   or the range is exhausted. the last chunk carries the final cursor
+	def iter_items(self, feed_id, since_spec, until_spec, max_count, chunk_size=50, filters=None, fields=None):
+		kwargs = dict()
+		if filters:
+			kwargs['filters'] = filters
+		if fields is not None:
+			kwargs['fields'] = fields
+		remaining = max_count
+		while True:
+			count = min(chunk_size, remaining)
+			# get_items may rewrite a spec on cursor fallback, so pass copies
+			result = self.get_items(feed_id, copy.copy(since_spec), copy.copy(until_spec), count, **kwargs)
+			yield result
+			remaining -= len(result.items)
+			if remaining <= 0 or len(result.items) < count or not result.last_cursor:
+				break
+			since_spec = PositionSpec('cursor', result.last_cursor)
+
+	# generate ItemsResult chunks containing the state of every item in the
+	#   base at a single point in time. the last chunk carries a cursor for the
+	#   modified ordering, for incremental sync from the snapshot onwards
+	def get_snapshot(self, base, deleted=True, chunk_size=100):
+		raise NotImplementedError('snapshots not implemented')
+
 	def db_psh_sub_set(self, feed_id, uri):
 		raise NotImplementedError('PubSubHubbub subscriptions not implemented')
 
 	def db_psh_sub_remove(self, feed_id, uri):
 		raise NotImplementedError('PubSubHubbub subscriptions not implemented')
 
+	# return (next scan cursor, list of callback uris). a next cursor of 0
+	#   means the scan is complete
+	def get_psh_subs(self, feed_id, cursor=0, count=100):
+		raise NotImplementedError('PubSubHubbub subscriptions not implemented')
+
+	# generate all callback uris of the feed
+	def iter_psh_subs(self, feed_id, count=100):
+		cursor = 0
+		while True:
+			cursor, uris = self.get_psh_subs(feed_id, cursor, count=count)
+			for uri in uris:
+				yield uri
+			if cursor == 0:
+				break
+
 	def db_xmpp_sub_set(self, feed_id, uri):
 		raise NotImplementedError('XMPP subscriptions not implemented')
 
 	def db_xmpp_sub_remove(self, feed_id, uri):
 		raise NotImplementedError('XMPP subscriptions not implemented')
 
+# tracks which channels have subscribers, as reported by the GRIP proxy (see
+#   PushpinStatsListener) or by calls to update. reports expire after their
+#   ttl unless refreshed. until ttl seconds after start, reports of existing
+#   subscriptions may not have arrived yet, so every channel counts as
+#   subscribed.
+# reports are kept per source, e.g. a proxy instance and subscription mode,
+#   and a channel is subscribed while any source reports it. so one source
+#   losing its subscribers doesn't hide the channel from the others
+# listeners are called with the channel of each report of subscribers
+class ChannelTracker(object):
+	def __init__(self, ttl=60):
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		# channel -> dict of source -> expiration time
+		self.channels = dict()
+		self.started = time.time()
+		self.listeners = list()
+
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+
+	def update(self, channel, subscribers, ttl=None, source=None):
+		if ttl is None:
+			ttl = self.ttl
+		with self.lock:
+			if subscribers > 0:
+				self.channels.setdefault(channel, dict())[source] = time.time() + ttl
+			else:
+				sources = self.channels.get(channel)
+				if sources is not None:
+					sources.pop(source, None)
+					if not sources:
+						del self.channels[channel]
+		if subscribers > 0:
+			for listener in self.listeners:
+				try:
+					listener(channel)
+				except:
+					# never let a reporter die
+					pass
+
+	def is_subscribed(self, channel):
+		now = time.time()
+		if now < self.started + self.ttl:
+			return True
+		with self.lock:
+			sources = self.channels.get(channel)
+			if sources is None:
+				return False
+			for source, expires in sources.items():
+				if expires <= now:
+					del sources[source]
+			if not sources:
+				del self.channels[channel]
+				return False
+			return True
+
+# feeds a ChannelTracker with the subscription reports of pushpin, read
+#   from its stats socket (e.g. ipc:///var/run/pushpin/pushpin-stats).
+#   requires the zmq and tnetstring modules
+class PushpinStatsListener(object):
+	def __init__(self, tracker, spec):
+		if zmq is None or tnetstring is None:
+			raise ValueError('reading pushpin stats requires the zmq and tnetstring modules')
+		self.tracker = tracker
+		self.spec = spec
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self):
+		sock = zmq.Context.instance().socket(zmq.SUB)
+		sock.setsockopt(zmq.SUBSCRIBE, 'sub ')
+		sock.connect(self.spec)
+		while True:
+			self._process(sock.recv())
+
+	# messages are the type, a space, and 'T' followed by a tnetstring
+	def _process(self, message):
+		at = message.find(' ')
+		if message[:at] != 'sub' or message[at + 1:at + 2] != 'T':
+			return
+		data = tnetstring.loads(message[at + 2:])
+		if data.get('unavailable'):
+			subscribers = 0
+		else:
+			subscribers = data.get('subscribers', 1)
+		# instances report their own subscriptions, separately for
+		#   response and stream holds
+		self.tracker.update(data['channel'], subscribers, ttl=data.get('ttl'), source=(data.get('from'), data.get('mode')))
+
 class EpcpPublisher(Publisher):
-	def __init__(self, pub_control_set, prefix=None, formatter=None):
+	# with a tracker, nothing is rendered or published for channels without
+	#   subscribers. the proxy reports a subscription only after holding the
+	#   request, so publishes skipped in between would otherwise never reach
+	#   it. they are kept for grace seconds, and published once the channel
+	#   is reported subscribed
+	def __init__(self, pub_control_set, prefix=None, formatter=None, tracker=None, grace=2):
 		self.pub = pub_control_set
 		self.prefix = prefix
 		if self.prefix is None:
 			self.prefix = ''
 		self.formatter = formatter
-
+		self.tracker = tracker
+		self.grace = grace
+		self.lock = threading.Lock()
+		# channel -> list of (time, publish args) skipped
+		self.skipped = dict()
+		self.next_prune = time.time() + self.grace
+		if self.tracker is not None:
+			self.tracker.add_listener(self._replay)
+
+	# the GRIP proxy has no part in webhooks. PshPublisher delivers to the
+	#   subscribers stored by the model
 	def psh_sub_set(self, feed_id, uri):
-		# TODO
 		pass
 
 	def psh_sub_remove(self, feed_id, uri):
-		# TODO
 		pass
 
 	def xmpp_sub_set(self, feed_id, jid):
@@ -264,12 +629,96 @@ class EpcpPublisher(Publisher):
 		# TODO
 		pass
 
-	def publish(self, feed_id, item, total, cursor, prev_cursor):
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		self.publish_items(feed_id, [item], total, [cursor], prev_cursor, deleted_total=deleted_total)
+
+	# response and request bodies carry all of the items, while streams get
+	#   an entry for each item with its own cursor
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		channels = list()
 		for iformat in ('atom', 'json'):
 			if (self.formatter and self.formatter.is_supported(iformat)) or (not self.formatter and iformat == 'json'):
-				self._publish(feed_id, item, iformat, total, cursor, prev_cursor)
+				channels.append((get_channel(self.prefix, feed_id, iformat), iformat))
+				if iformat == 'json':
+					channels.append((get_sse_channel(self.prefix, feed_id), 'sse'))
+		channels.append((get_hint_channel(self.prefix, feed_id), 'hint'))
+
+		for channel, kind in channels:
+			args = (kind, items, total, cursors, prev_cursor, deleted_total)
+			if self._is_subscribed(channel):
+				# skipped publishes go first
+				if channel in self.skipped:
+					self._replay(channel)
+				self.pub.publish(channel, self._make_channel_item(*args))
+			else:
+				self._skip(channel, args)
+
+	def _is_subscribed(self, channel):
+		return (self.tracker is None or self.tracker.is_subscribed(channel))
+
+	def _make_channel_item(self, kind, items, total, cursors, prev_cursor, deleted_total):
+		if kind == 'hint':
+			return pubcontrol.Item(HttpResponseHintFormat())
+		elif kind == 'sse':
+			return self._make_sse_item(items, total, cursors, prev_cursor, deleted_total)
+		else:
+			return self._make_item(items, kind, total, cursors, prev_cursor, deleted_total)
+
+	def _skip(self, channel, args):
+		now = time.time()
+		with self.lock:
+			self.skipped.setdefault(channel, list()).append((now, args))
+			if now >= self.next_prune:
+				for c, pubs in self.skipped.items():
+					pubs = [p for p in pubs if p[0] + self.grace > now]
+					if pubs:
+						self.skipped[c] = pubs
+					else:
+						del self.skipped[c]
+				self.next_prune = now + self.grace
+
+		# the report may have arrived meanwhile
+		if self._is_subscribed(channel):
+			self._replay(channel)
+
+	# publish what was skipped within the grace period. entries are removed
+	#   only once published, so that a concurrent publish to the channel
+	#   waits for them and stays in order
+	def _replay(self, channel):
+		if channel not in self.skipped:
+			return
+		with self.lock:
+			pubs = self.skipped.get(channel)
+			if pubs is None:
+				return
+			now = time.time()
+			for t, args in pubs:
+				if t + self.grace > now:
+					self.pub.publish(channel, self._make_channel_item(*args))
+			del self.skipped[channel]
+
+	def _make_stream_content(self, item, total, cursor, prev_cursor, deleted_total=None):
+		return create_stream_content(item, total, cursor, prev_cursor, formatter=self.formatter, deleted_total=deleted_total)
+
+	# return (item, cursor, prev_cursor) for each item
+	def _chain(self, items, cursors, prev_cursor):
+		out = list()
+		for n, item in enumerate(items):
+			if n > 0:
+				prev = cursors[n - 1]
+			else:
+				prev = prev_cursor
+			out.append((item, cursors[n], prev))
+		return out
+
+	def _make_sse_item(self, items, total, cursors, prev_cursor, deleted_total=None):
+		content = ''
+		for item, cursor, prev in self._chain(items, cursors, prev_cursor):
+			content += create_sse_event(json.dumps(self._make_stream_content(item, total, cursor, prev, deleted_total)), id=cursor)
+		return pubcontrol.Item(gripcontrol.HttpStreamFormat(content), cursors[-1], prev_cursor)
 
-	def _make_item(self, item, item_format, total, cursor, prev_cursor):
+	def _make_item(self, items, item_format, total, cursors, prev_cursor, deleted_total=None):
+		cursor = cursors[-1]
 		if item_format == 'atom':
 			hr_headers = dict()
 			hr_headers['Content-Type'] = 'application/atom+xml'
@@ -279,24 +728,15 @@ class EpcpPublisher(Publisher):
 			#hrq_body =
 			#xs_content =
 		elif item_format == 'json':
-			content_type, hr_body = create_items_body(item_format, [item], total=total, last_cursor=cursor, formatter=self.formatter)
+			content_type, hr_body = create_items_body(item_format, items, total=total, last_cursor=cursor, formatter=self.formatter, deleted_total=deleted_total)
 			hr_headers = dict()
 			hr_headers['Content-Type'] = content_type
 
-			hs_content = dict()
-			if total is not None:
-				hs_content['total'] = total
-			if prev_cursor is not None:
-				hs_content['prev_cursor'] = prev_cursor
-			if cursor is not None:
-				hs_content['cursor'] = cursor
-			if self.formatter:
-				hs_content['item'] = self.formatter.to_format(item, item_format)
-			else:
-				hs_content['item'] = item # assume json ready
-			hs_content = json.dumps(hs_content) + '\n'
+			hs_content = ''
+			for item, icursor, prev in self._chain(items, cursors, prev_cursor):
+				hs_content += json.dumps(self._make_stream_content(item, total, icursor, prev, deleted_total)) + '\n'
 
-			content_type, hrq_body = create_items_body(item_format, [item], total=total, prev_cursor=prev_cursor, last_cursor=cursor, formatter=self.formatter)
+			content_type, hrq_body = create_items_body(item_format, items, total=total, prev_cursor=prev_cursor, last_cursor=cursor, formatter=self.formatter, deleted_total=deleted_total)
 			hrq_headers = dict()
 			hrq_headers['Content-Type'] = content_type
 
@@ -310,8 +750,433 @@ class EpcpPublisher(Publisher):
 
 		return pubcontrol.Item(pub_formats, cursor, prev_cursor)
 
-	def _publish(self, feed_id, item, iformat, total, cursor, prev_cursor):
-		self.pub.publish(self.prefix + encode_id_part(feed_id) + '-' + encode_id_part(iformat), self._make_item(item, iformat, total, cursor, prev_cursor))
+# collects notifications of each feed for up to window seconds and passes
+#   them on as a single publish_items call, so that long-polling clients
+#   receive bursts in one response. notifications that don't continue the
+#   collected chain start a new one. one thread publishes the batches as
+#   they come due
+# notifications are collected after the model has acknowledged them, so
+#   any collected when the process dies are lost. the model doesn't retry
+#   them, and clients only learn of them on their next query
+class CoalescingPublisher(Publisher):
+	def __init__(self, publisher, window=0.05, max_items=50):
+		self.publisher = publisher
+		self.window = window
+		self.max_items = max_items
+		self.lock = threading.Lock()
+		self.cond = threading.Condition(self.lock)
+		# feed id -> dict of items, cursors, prev_cursor, total, deleted_total
+		self.pending = dict()
+		# heap of (due time, feed id, batch)
+		self.due = list()
+		self.thread = None
+		atexit.register(self.flush)
+
+	def _start(self):
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self._flush_loop)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def psh_sub_set(self, feed_id, uri):
+		self.publisher.psh_sub_set(feed_id, uri)
+
+	def psh_sub_remove(self, feed_id, uri):
+		self.publisher.psh_sub_remove(feed_id, uri)
+
+	def xmpp_sub_set(self, feed_id, jid):
+		self.publisher.xmpp_sub_set(feed_id, jid)
+
+	def xmpp_sub_remove(self, feed_id, jid):
+		self.publisher.xmpp_sub_remove(feed_id, jid)
+
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		self.publish_items(feed_id, [item], total, [cursor], prev_cursor, deleted_total=deleted_total)
+
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		self._start()
+		ready = list()
+		with self.lock:
+			batch = self.pending.get(feed_id)
+			if batch is not None and batch['cursors'][-1] != prev_cursor:
+				ready.append((feed_id, self.pending.pop(feed_id)))
+				batch = None
+			if batch is None:
+				batch = dict()
+				batch['items'] = list()
+				batch['cursors'] = list()
+				batch['prev_cursor'] = prev_cursor
+				self.pending[feed_id] = batch
+				heapq.heappush(self.due, (time.time() + self.window, feed_id, batch))
+				self.cond.notify()
+			batch['items'].extend(items)
+			batch['cursors'].extend(cursors)
+			batch['total'] = total
+			batch['deleted_total'] = deleted_total
+			if len(batch['items']) >= self.max_items:
+				ready.append((feed_id, self.pending.pop(feed_id)))
+
+		for feed_id, batch in ready:
+			self._publish_batch(feed_id, batch)
+
+	# publish everything collected so far
+	def flush(self):
+		with self.lock:
+			ready = self.pending.items()
+			self.pending = dict()
+			self.due = list()
+		for feed_id, batch in ready:
+			self._publish_batch(feed_id, batch)
+
+	def _flush_loop(self):
+		while True:
+			with self.cond:
+				while not self.due or self.due[0][0] > time.time():
+					if self.due:
+						self.cond.wait(self.due[0][0] - time.time())
+					else:
+						self.cond.wait()
+				due, feed_id, batch = heapq.heappop(self.due)
+				# the batch may have been published already
+				if self.pending.get(feed_id) is not batch:
+					continue
+				del self.pending[feed_id]
+			try:
+				self._publish_batch(feed_id, batch)
+			except:
+				# never let the flusher die
+				pass
+
+	def _publish_batch(self, feed_id, batch):
+		self.publisher.publish_items(feed_id, batch['items'], batch['total'], batch['cursors'], batch['prev_cursor'], deleted_total=batch['deleted_total'])
+
+# passes everything on to each of a list of publishers
+class PublisherSet(Publisher):
+	def __init__(self, publishers):
+		self.publishers = publishers
+
+	def psh_sub_set(self, feed_id, uri):
+		for p in self.publishers:
+			p.psh_sub_set(feed_id, uri)
+
+	def psh_sub_remove(self, feed_id, uri):
+		for p in self.publishers:
+			p.psh_sub_remove(feed_id, uri)
+
+	def xmpp_sub_set(self, feed_id, jid):
+		for p in self.publishers:
+			p.xmpp_sub_set(feed_id, jid)
+
+	def xmpp_sub_remove(self, feed_id, jid):
+		for p in self.publishers:
+			p.xmpp_sub_remove(feed_id, jid)
+
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		for p in self.publishers:
+			call_publish(p, feed_id, item, total, cursor, prev_cursor, deleted_total=deleted_total)
+
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		for p in self.publishers:
+			p.publish_items(feed_id, items, total, cursors, prev_cursor, deleted_total=deleted_total)
+
+# confirm a PubSubHubbub (un)subscription request with the subscriber, by
+#   having it echo a challenge. redirects are not followed. return true if
+#   confirmed
+def verify_psh_callback(callback, mode, topic, timeout=10):
+	challenge = str(uuid.uuid4())
+	params = dict()
+	params['hub.mode'] = mode
+	params['hub.topic'] = topic
+	params['hub.challenge'] = challenge
+	parts = urlparse.urlsplit(callback)
+	path = parts.path or '/'
+	if parts.query:
+		path += '?' + parts.query + '&' + urllib.urlencode(params)
+	else:
+		path += '?' + urllib.urlencode(params)
+	if parts.scheme == 'https':
+		conn = httplib.HTTPSConnection(parts.netloc, timeout=timeout)
+	else:
+		conn = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+	try:
+		conn.request('GET', path)
+		resp = conn.getresponse()
+		# the challenge is short, so don't read more than needed to compare
+		return (resp.status // 100 == 2 and resp.read(len(challenge) + 100).strip() == challenge)
+	except (httplib.HTTPException, IOError):
+		return False
+	finally:
+		conn.close()
+
+# return true if the address is loopback, private, link-local or otherwise
+#   not reachable on the internet
+def is_private_address(addr):
+	try:
+		packed = socket.inet_pton(socket.AF_INET, addr)
+	except socket.error:
+		packed = None
+	if packed is not None:
+		a = ord(packed[0])
+		b = ord(packed[1])
+		return (a in (0, 10, 127) or a >= 224 or (a == 100 and b & 0xc0 == 64) or (a == 169 and b == 254) or (a == 172 and b & 0xf0 == 16) or (a == 192 and b == 168) or (a == 198 and b & 0xfe == 18))
+	packed = socket.inet_pton(socket.AF_INET6, addr.split('%')[0])
+	if packed[:12] == '\x00' * 10 + '\xff\xff':
+		# ipv4-mapped
+		return is_private_address(socket.inet_ntop(socket.AF_INET, packed[12:]))
+	a = ord(packed[0])
+	b = ord(packed[1])
+	# unspecified, loopback and ipv4-compatible, unique local, link-local,
+	#   multicast
+	return (a == 0 or a & 0xfe == 0xfc or (a == 0xfe and b & 0xc0 == 0x80) or a == 0xff)
+
+# POSTs bodies to callback uris from a pool of worker threads. connections
+#   are kept alive per worker, at most host_limit requests go to the same
+#   host at once, and failed requests are retried with exponential backoff.
+#   deliver, fanout and verify only queue work, so callers never wait on
+#   the network. at most max_pending jobs are kept, and any more are
+#   dropped (these calls then return false), so that slow or dead
+#   subscribers can't use up memory.
+# callbacks are only contacted if their host is one of allowed_hosts, or
+#   resolves to public addresses only, so that subscribers can't have
+#   requests made to internal services
+class WebhookDeliverer(object):
+	def __init__(self, workers=10, host_limit=2, retries=5, backoff=1, timeout=10, allowed_hosts=None, max_pending=10000):
+		self.workers = workers
+		self.host_limit = host_limit
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.allowed_hosts = allowed_hosts
+		if self.allowed_hosts is None:
+			self.allowed_hosts = list()
+		# host -> (time checked, allowed)
+		self.host_checks = dict()
+		self.queue = Queue.Queue()
+		self.lock = threading.Lock()
+		self.cond = threading.Condition(self.lock)
+		# host -> dict of active count and waiting jobs
+		self.hosts = dict()
+		# heap of (due time, job)
+		self.retry_jobs = list()
+		# jobs queued, running, waiting on their host or waiting to retry
+		self.outstanding = 0
+		self.max_pending = max_pending
+		self.delivered = 0
+		self.failed = 0
+		self.dropped = 0
+		self.threads = None
+		self.tlocal = threading.local()
+
+	def _start(self):
+		with self.lock:
+			if self.threads is not None:
+				return
+			self.threads = list()
+			for n in range(self.workers):
+				self.threads.append(threading.Thread(target=self._work))
+			self.threads.append(threading.Thread(target=self._retry_loop))
+			for t in self.threads:
+				t.daemon = True
+				t.start()
+
+	def deliver(self, uri, headers, body):
+		self._start()
+		return self._queue(('deliver', uri, headers, body, 0))
+
+	# deliver to each uri generated by get_uris, which is called from a worker
+	def fanout(self, get_uris, headers, body):
+		self._start()
+		return self._queue(('fanout', get_uris, headers, body))
+
+	# confirm a PubSubHubbub (un)subscription with the subscriber, and call
+	#   on_verified from a worker if it does
+	def verify(self, callback, mode, topic, on_verified):
+		self._start()
+		return self._queue(('verify', callback, mode, topic, on_verified))
+
+	# block until everything queued so far is delivered or has failed.
+	#   return false on timeout
+	def flush(self, timeout=None):
+		if timeout is not None:
+			end = time.time() + timeout
+		with self.cond:
+			while self.outstanding > 0:
+				if timeout is not None:
+					remaining = end - time.time()
+					if remaining <= 0:
+						return False
+					self.cond.wait(remaining)
+				else:
+					self.cond.wait()
+		return True
+
+	# jobs waiting on their host or to retry count too, as that is where a
+	#   slow subscriber's jobs pile up
+	def _queue(self, job):
+		with self.lock:
+			if self.outstanding >= self.max_pending:
+				self.dropped += 1
+				return False
+			self.outstanding += 1
+		self.queue.put(job)
+		return True
+
+	def _done(self, delivered=None):
+		with self.cond:
+			self.outstanding -= 1
+			if delivered is True:
+				self.delivered += 1
+			elif delivered is False:
+				self.failed += 1
+			self.cond.notify_all()
+
+	def _work(self):
+		while True:
+			job = self.queue.get()
+			try:
+				if job[0] == 'fanout':
+					self._fanout(job)
+				elif job[0] == 'verify':
+					self._verify(job)
+				else:
+					self._deliver(job)
+			except:
+				# never let a worker die
+				self._done(False)
+
+	def _fanout(self, job):
+		kind, get_uris, headers, body = job
+		for uri in get_uris():
+			self._queue(('deliver', uri, headers, body, 0))
+		self._done()
+
+	def _verify(self, job):
+		kind, callback, mode, topic, on_verified = job
+		verified = (self._is_allowed(callback) and verify_psh_callback(callback, mode, topic, timeout=self.timeout))
+		if verified:
+			on_verified()
+		self._done(verified)
+
+	# addresses are rechecked once a minute
+	def _is_allowed(self, uri):
+		host = urlparse.urlsplit(uri).hostname
+		if not host:
+			return False
+		if host in self.allowed_hosts:
+			return True
+		now = time.time()
+		checked = self.host_checks.get(host)
+		if checked is None or checked[0] + 60 < now:
+			try:
+				addrs = [a[4][0] for a in socket.getaddrinfo(host, None)]
+				allowed = (len(addrs) > 0 and not any(is_private_address(a) for a in addrs))
+			except (socket.error, ValueError):
+				allowed = False
+			checked = (now, allowed)
+			self.host_checks[host] = checked
+		return checked[1]
+
+	def _deliver(self, job):
+		kind, uri, headers, body, attempt = job
+		if not self._is_allowed(uri):
+			self._done(False)
+			return
+		host = urlparse.urlsplit(uri).netloc
+		with self.lock:
+			h = self.hosts.get(host)
+			if h is None:
+				h = dict(active=0, waiting=collections.deque())
+				self.hosts[host] = h
+			if h['active'] >= self.host_limit:
+				# picked up again when a request to the host completes
+				h['waiting'].append(job)
+				return
+			h['active'] += 1
+
+		try:
+			status = self._request(uri, headers, body)
+		finally:
+			with self.lock:
+				h['active'] -= 1
+				next_job = None
+				if h['waiting']:
+					next_job = h['waiting'].popleft()
+				elif h['active'] == 0:
+					del self.hosts[host]
+			if next_job is not None:
+				self.queue.put(next_job)
+
+		if status is not None and status // 100 == 2:
+			self._done(True)
+		elif (status is None or status >= 500 or status == 429) and attempt < self.retries:
+			delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+			with self.cond:
+				heapq.heappush(self.retry_jobs, (time.time() + delay, (kind, uri, headers, body, attempt + 1)))
+				self.cond.notify_all()
+		else:
+			self._done(False)
+
+	# return status code, or None if the request didn't complete
+	def _request(self, uri, headers, body):
+		parts = urlparse.urlsplit(uri)
+		if not hasattr(self.tlocal, 'conns'):
+			self.tlocal.conns = dict()
+		key = (parts.scheme, parts.netloc)
+		conn = self.tlocal.conns.get(key)
+		if conn is None:
+			if parts.scheme == 'https':
+				conn = httplib.HTTPSConnection(parts.netloc, timeout=self.timeout)
+			else:
+				conn = httplib.HTTPConnection(parts.netloc, timeout=self.timeout)
+			self.tlocal.conns[key] = conn
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		try:
+			conn.request('POST', path, body, headers)
+			resp = conn.getresponse()
+			resp.read()
+			if resp.getheader('connection', '').lower() == 'close':
+				conn.close()
+				del self.tlocal.conns[key]
+			return resp.status
+		except (httplib.HTTPException, IOError):
+			conn.close()
+			del self.tlocal.conns[key]
+			return None
+
+	def _retry_loop(self):
+		while True:
+			with self.cond:
+				while not self.retry_jobs or self.retry_jobs[0][0] > time.time():
+					if self.retry_jobs:
+						self.cond.wait(self.retry_jobs[0][0] - time.time())
+					else:
+						self.cond.wait()
+				due, job = heapq.heappop(self.retry_jobs)
+			self.queue.put(job)
+
+# delivers published items to the PubSubHubbub subscribers of the feed, as
+#   stored by the model
+class PshPublisher(Publisher):
+	def __init__(self, model, deliverer=None, formatter=None):
+		self.model = model
+		self.deliverer = deliverer
+		if self.deliverer is None:
+			self.deliverer = WebhookDeliverer()
+		self.formatter = formatter
+
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		self.publish_items(feed_id, [item], total, [cursor], prev_cursor, deleted_total=deleted_total)
+
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		content_type, body = create_items_body('json', items, total=total, prev_cursor=prev_cursor, last_cursor=cursors[-1], formatter=self.formatter, deleted_total=deleted_total)
+		headers = dict()
+		headers['Content-Type'] = content_type
+		# subscribers are looked up by a worker, not the writer
+		self.deliverer.fanout(lambda: self.model.iter_psh_subs(feed_id), headers, body)
 
 class Item(object):
 	def __init__(self):
@@ -342,7 +1207,30 @@ class DefaultFormatter(Formatter):
 		return out
 
 class RedisModel(Model):
-	def __init__(self, host=None, port=None, db=None, prefix=None, ttl=None, publisher=None):
+	# ttl is how long deleted items are kept, and item_ttl how long items are
+	#   kept after their last modification (None to keep them). both are in
+	#   seconds, and are applied by RedisSweeper.
+	# orderings maps extra order names to functions of item data returning an
+	#   integer score, or None to leave the item out of that ordering. these
+	#   indexes are maintained along with created/modified and can be queried
+	#   the same way, but since scores may move backwards they are not published.
+	# filters maps filter names to functions of item data returning a value or
+	#   list of values (or None). items are indexed by each value at write time,
+	#   and get_items can then be limited to items having given values.
+	# with inline_notify, writers publish queued notifications themselves.
+	#   otherwise this is left to RedisNotifyWorker. either way, one process
+	#   at a time publishes the notifications of a base, in order.
+	# besides created and modified, items are kept in a live index until they
+	#   are deleted. it is ordered by created time, and published for new items
+	#   and deletions.
+	# with item_compression, item records are written in a compact form
+	#   compressed with zstandard, using the dictionary of the base if one
+	#   has been trained. records in either form can always be read, and
+	#   migrate_items rewrites existing ones.
+	# with large_field_size, top-level fields of item data whose json is
+	#   larger than this many bytes are stored apart from the item record,
+	#   and only read when returned
+	def __init__(self, host=None, port=None, db=None, prefix=None, ttl=None, publisher=None, item_ttl=None, orderings=None, filters=None, inline_notify=True, item_compression=False, large_field_size=None):
 		super(RedisModel, self).__init__(publisher)
 		self.prefix = prefix
 		if not self.prefix:
@@ -350,7 +1238,31 @@ class RedisModel(Model):
 		self.redis = redis.Redis(host=host, port=port, db=db)
 		self.ttl = ttl
 		if not self.ttl:
-			self.ttl = 1000 * 60 * 2
+			self.ttl = 60 * 2
+		self.item_ttl = item_ttl
+		self.orderings = orderings
+		if self.orderings is None:
+			self.orderings = dict()
+		for name in self.orderings.keys():
+			if name in ('created', 'modified', 'deleted', 'live'):
+				raise ValueError('reserved order name: %s' % name)
+		self.filters = filters
+		if self.filters is None:
+			self.filters = dict()
+		self.inline_notify = inline_notify
+		self.item_compression = item_compression
+		if self.item_compression and zstandard is None:
+			raise ValueError('item_compression requires the zstandard module')
+		# (enc_base, dict id) -> compression dict
+		self.zdicts = dict()
+		# enc_base -> (time checked, dict id)
+		self.zdict_current = dict()
+		self.large_field_size = large_field_size
+		# bases whose notifications from earlier versions have been drained
+		self.legacy_drained = set()
+		# seconds the publishing lock of a base is held without progress
+		#   before another process may take over
+		self.notify_lock_ttl = 30
 
 	# return (timestamp, offset, checksum)
 	def _get_spec_parts(self, redis, key_index, spec):
@@ -392,11 +1304,243 @@ class RedisModel(Model):
 			item.deleted = True
 		return item
 
-	def _item_serialize(self, item):
-		return json.dumps(self._item_to_structured(item))
-
-	def _item_deserialize(self, data):
-		return self._item_from_structured(json.loads(data))
+	# compact records are a marker byte followed by a zstandard frame of the
+	#   item as a json list. anything else is a json object. large, if set,
+	#   is [version, names] of the fields stored apart from the record
+	def _item_serialize(self, enc_base, item, large=None):
+		if not self.item_compression:
+			s = self._item_to_structured(item)
+			if large:
+				s['meta']['large'] = large
+			return json.dumps(s)
+		zdict = self._get_zdict(enc_base, self._get_zdict_current(enc_base))
+		if zdict is not None:
+			c = zstandard.ZstdCompressor(dict_data=zdict)
+		else:
+			c = zstandard.ZstdCompressor()
+		return '\x01' + c.compress(self._item_to_compact(item, large))
+
+	def _item_deserialize(self, enc_base, data):
+		return self._item_deserialize_ext(enc_base, data)[0]
+
+	# return (item, large)
+	def _item_deserialize_ext(self, enc_base, data):
+		if data.startswith('\x01'):
+			if zstandard is None:
+				raise ValueError('compressed item record requires the zstandard module')
+			frame = data[1:]
+			zdict = self._get_zdict(enc_base, zstandard.get_frame_parameters(frame).dict_id)
+			if zdict is not None:
+				d = zstandard.ZstdDecompressor(dict_data=zdict)
+			else:
+				d = zstandard.ZstdDecompressor()
+			return self._item_from_compact(d.decompress(frame))
+		s = json.loads(data)
+		return (self._item_from_structured(s), s['meta'].get('large'))
+
+	def _item_to_compact(self, item, large=None):
+		s = self._item_to_structured(item)
+		meta = s['meta']
+		out = [meta['id'], meta['created'], meta['modified'], 1 if item.deleted else 0, s['data']]
+		if large:
+			out.append(large)
+		return json.dumps(out, separators=(',', ':'))
+
+	# return (item, large)
+	def _item_from_compact(self, data):
+		data = json.loads(data)
+		item = Item()
+		item.id = data[0]
+		item.created = datetime.utcfromtimestamp(data[1])
+		item.modified = datetime.utcfromtimestamp(data[2])
+		item.deleted = bool(data[3])
+		item.data = data[4]
+		return (item, data[5] if len(data) > 5 else None)
+
+	def _get_large_field_ref(self, id, name):
+		parts = list()
+		for part in (id, name):
+			if isinstance(part, unicode):
+				part = part.encode('utf-8')
+			parts.append(encode_id_part(part))
+		return parts[0] + '-' + parts[1]
+
+	def _get_large_field_refs(self, id, large):
+		if not large:
+			return list()
+		return [self._get_large_field_ref(id, name) for name in large[1]]
+
+	# return (record item, large, dict of field refs to stored values). the
+	#   stored values carry the version of the record they belong to, since
+	#   they are read separately from it
+	def _item_split(self, item):
+		if not self.large_field_size or item.deleted or not isinstance(item.data, dict):
+			return (item, None, dict())
+		version = uuid.uuid4().hex[:8]
+		data = dict()
+		names = list()
+		values = dict()
+		for name, value in item.data.items():
+			encoded = json.dumps(value)
+			if len(encoded) > self.large_field_size:
+				names.append(name)
+				values[self._get_large_field_ref(item.id, name)] = '[%s,%s]' % (json.dumps(version), encoded)
+			else:
+				data[name] = value
+		if not names:
+			return (item, None, dict())
+		record = copy.copy(item)
+		record.data = data
+		return (record, [version, sorted(names)], values)
+
+	# fill in the large fields of items from (item, large) pairs, or only
+	#   those in fields if set. return false if a record was changed since it
+	#   was read
+	def _load_large_fields(self, enc_base, entries, fields=None):
+		wanted = list()
+		for item, large in entries:
+			if not large:
+				continue
+			for name in large[1]:
+				if fields is None or name in fields:
+					wanted.append((item, large[0], name))
+		if not wanted:
+			return True
+		values = self.redis.hmget('%s%s-item-fields' % (self.prefix, enc_base), [self._get_large_field_ref(item.id, name) for item, version, name in wanted])
+		for (item, version, name), value in zip(wanted, values):
+			if value is None:
+				return False
+			value_version, value = json.loads(value)
+			if value_version != version:
+				return False
+			item.data[name] = value
+		return True
+
+	def _project(self, item, fields):
+		if fields is not None and isinstance(item.data, dict):
+			data = dict()
+			for name in fields:
+				if name in item.data:
+					data[name] = item.data[name]
+			item.data = data
+
+	# return true if the record is stored the way it would be written now
+	def _is_current_form(self, enc_base, data):
+		if not data.startswith('\x01'):
+			return not self.item_compression
+		if not self.item_compression:
+			return False
+		return (zstandard.get_frame_parameters(data[1:]).dict_id == self._get_zdict_current(enc_base))
+
+	# return dict id new records of the base are compressed with, or 0.
+	#   checked once a minute, so a newly trained dictionary is picked up
+	def _get_zdict_current(self, enc_base):
+		now = time.time()
+		checked = self.zdict_current.get(enc_base)
+		if checked is None or checked[0] + 60 < now:
+			dict_id = int(self.redis.get('%s%s-zdict' % (self.prefix, enc_base)) or 0)
+			checked = (now, dict_id)
+			self.zdict_current[enc_base] = checked
+		return checked[1]
+
+	# return compression dict, or None for dict id 0. dictionaries are never
+	#   changed once stored, so they are cached indefinitely
+	def _get_zdict(self, enc_base, dict_id):
+		if not dict_id:
+			return None
+		zdict = self.zdicts.get((enc_base, dict_id))
+		if zdict is None:
+			data = self.redis.hget('%s%s-zdicts' % (self.prefix, enc_base), dict_id)
+			if data is None:
+				raise ValueError('compression dictionary missing: %d' % dict_id)
+			zdict = zstandard.ZstdCompressionDict(data)
+			self.zdicts[(enc_base, dict_id)] = zdict
+		return zdict
+
+	# train a compression dictionary from a sample of the items of the base,
+	#   and use it for records written from then on. return its id
+	def train_item_dictionary(self, base, samples=1000, dict_size=16384):
+		if zstandard is None:
+			raise ValueError('dictionary training requires the zstandard module')
+		enc_base = encode_id_part(base)
+		key_items = '%s%s-items' % (self.prefix, enc_base)
+		out = list()
+		cursor = 0
+		while True:
+			cursor, records = self.redis.hscan(key_items, cursor, count=min(samples, 1000))
+			for data in records.values():
+				out.append(self._item_to_compact(self._item_deserialize(enc_base, data)))
+			if cursor == 0 or len(out) >= samples:
+				break
+		zdict = zstandard.train_dictionary(dict_size, out[:samples])
+		dict_id = zdict.dict_id()
+		with self.redis.pipeline() as pipe:
+			pipe.hset('%s%s-zdicts' % (self.prefix, enc_base), dict_id, zdict.as_bytes())
+			pipe.set('%s%s-zdict' % (self.prefix, enc_base), dict_id)
+			pipe.execute()
+		self.zdict_current[enc_base] = (time.time(), dict_id)
+		return dict_id
+
+	# bring up to count item records of the base up to date, starting at the
+	#   given scan cursor: records are rewritten in the current storage form,
+	#   tombstones lose their data, large fields are moved out of records
+	#   written without them, and live items written by earlier versions
+	#   are added to the live index. return (next scan cursor, number
+	#   updated). a next cursor of 0 means the scan is complete
+	def migrate_items(self, base, cursor=0, count=100):
+		enc_base = encode_id_part(base)
+		key_items = '%s%s-items' % (self.prefix, enc_base)
+		key_index_live = '%s%s-index-live' % (self.prefix, enc_base)
+		key_item_fields = '%s%s-item-fields' % (self.prefix, enc_base)
+		next_cursor, records = self.redis.hscan(key_items, cursor, count=count)
+		updated = 0
+		for id, data in records.items():
+			item, large = self._item_deserialize_ext(enc_base, data)
+			# serializing again needn't give the same bytes, so records
+			#   already in the current form are only rewritten on changes
+			rewrite = not self._is_current_form(enc_base, data)
+			stale_refs = list()
+			large_values = dict()
+			if item.deleted:
+				if item.data is not None or large:
+					rewrite = True
+				item.data = None
+				stale_refs = self._get_large_field_refs(item.id, large)
+				large = None
+			elif not large:
+				item, large, large_values = self._item_split(item)
+				if large:
+					rewrite = True
+			if rewrite:
+				new_data = self._item_serialize(enc_base, item, large)
+			else:
+				new_data = data
+			while True:
+				with self.redis.pipeline() as pipe:
+					try:
+						pipe.watch(key_items)
+						pipe.watch(key_index_live)
+						# only update records nobody has changed meanwhile
+						if pipe.hget(key_items, id) != data:
+							break
+						add_live = (not item.deleted and pipe.zscore(key_index_live, id) is None)
+						if new_data == data and not add_live:
+							break
+						pipe.multi()
+						if new_data != data:
+							pipe.hset(key_items, id, new_data)
+						if stale_refs:
+							pipe.hdel(key_item_fields, *stale_refs)
+						if large_values:
+							pipe.hmset(key_item_fields, large_values)
+						if add_live:
+							pipe.zadd(key_index_live, id, calendar.timegm(item.created.utctimetuple()))
+						pipe.execute()
+						updated += 1
+						break
+					except redis.WatchError:
+						continue
+		return (int(next_cursor), updated)
 
 	def _ref_find(self, refs, id, score):
 		for n, i in enumerate(refs):
@@ -421,92 +1565,339 @@ class RedisModel(Model):
 			return 0
 		return -1
 
+	# every item, deleted or not, is in the created index until it expires, so
+	#   the counts follow from the index sizes. return (live, deleted)
+	def _get_totals(self, count_created, count_deleted):
+		return (count_created - count_deleted, count_deleted)
+
+	def _get_filter_ref(self, name, value):
+		parts = list()
+		for part in (name, value):
+			if isinstance(part, unicode):
+				part = part.encode('utf-8')
+			else:
+				part = str(part)
+			parts.append(encode_id_part(part))
+		return parts[0] + '-' + parts[1]
+
+	def _get_filter_key(self, enc_base, name, value):
+		return '%s%s-filter-%s' % (self.prefix, enc_base, self._get_filter_ref(name, value))
+
+	# return list of refs of the filter sets the item data belongs in
+	def _get_item_filter_refs(self, data):
+		out = list()
+		for name, f in self.filters.items():
+			values = f(data)
+			if values is None:
+				continue
+			if not isinstance(values, (list, tuple, set)):
+				values = [values]
+			for value in values:
+				ref = self._get_filter_ref(name, value)
+				if ref not in out:
+					out.append(ref)
+		return out
+
 	def _get_ids(self, refs):
 		out = list()
 		for i in refs:
 			out.append(i[0])
 		return out
 
-	def _rewrite_notify_props(self, base, notify_props):
-		enc_base = encode_id_part(base)
-		key_notify_items = '%s%s-notify-items' % (self.prefix, enc_base)
+	# return the cursor the id will have once added to the ids at a timestamp.
+	#   ids with equal scores are ordered by their bytes
+	def _get_insert_cursor(self, ts, ids, id):
+		if isinstance(id, unicode):
+			id = id.encode('utf-8')
+		ids = [i for i in ids if i != id]
+		bisect.insort(ids, id)
+		offset = ids.index(id)
+		return make_toc_cursor(ts, offset, ids[:offset + 1])
+
+	# queue a notification as part of a write transaction. the lastpub keys
+	#   hold the cursor of the latest write to each ordering, and become the
+	#   prev_cursor of the next one. they advance even for writes that aren't
+	#   published, so that subscribers detect the gap and query again
+	def _queue_notify(self, pipe, enc_base, key_notify, item, cursors, prev_cursors, total, deleted_total, notify):
+		for index, cursor in cursors.items():
+			pipe.set('%s%s-lastpub-%s' % (self.prefix, enc_base, index), cursor)
+		if notify:
+			notify_props = dict()
+			notify_props['item'] = self._item_to_structured(item)
+			notify_props['cursors'] = cursors
+			notify_props['prev_cursors'] = prev_cursors
+			notify_props['total'] = total
+			notify_props['deleted_total'] = deleted_total
+			pipe.execute_command('XADD', key_notify, '*', 'props', json.dumps(notify_props))
+			pipe.sadd('%snotify-bases' % self.prefix, enc_base)
+
+	def _get_notify_consumer(self):
+		return '%s-%d' % (socket.gethostname(), os.getpid())
+
+	def _read_notify(self, key_notify, count):
+		ret = self.redis.execute_command('XREADGROUP', 'GROUP', 'publishers', self._get_notify_consumer(), 'COUNT', count, 'STREAMS', key_notify, '>')
+		if not ret:
+			return []
+		return ret[0][1]
+
+	def _create_notify_group(self, key_notify):
+		try:
+			self.redis.execute_command('XGROUP', 'CREATE', key_notify, 'publishers', '0', 'MKSTREAM')
+		except redis.ResponseError as e:
+			if not str(e).startswith('BUSYGROUP'):
+				raise
+
+	# claim entries read by an earlier holder of the publishing lock that
+	#   went away before acknowledging them
+	def _claim_notify(self, key_notify, count):
+		try:
+			pending = self.redis.execute_command('XPENDING', key_notify, 'publishers', '-', '+', count)
+		except redis.ResponseError as e:
+			if not str(e).startswith('NOGROUP'):
+				raise
+			self._create_notify_group(key_notify)
+			return []
+		if not pending:
+			return []
+
+		entry_ids = [p[0] for p in pending]
+		entries = [e for e in self.redis.execute_command('XCLAIM', key_notify, 'publishers', self._get_notify_consumer(), 0, *entry_ids) if e]
+
+		# entries deleted after publishing but before being acknowledged
+		#   can't be claimed, and would otherwise stay pending forever
+		claimed_ids = set(e[0] for e in entries)
+		for entry_id in entry_ids:
+			if entry_id not in claimed_ids:
+				self.redis.execute_command('XACK', key_notify, 'publishers', entry_id)
+
+		return entries
+
+	# return False if the lock is no longer held with the token
+	def _renew_notify_lock(self, key_lock, token, release=False):
 		while True:
 			with self.redis.pipeline() as pipe:
 				try:
-					pipe.watch(key_notify_items)
-					if not pipe.hexists(key_notify_items, notify_props['id']):
-						# seems our item is gone. oh well
+					pipe.watch(key_lock)
+					if pipe.get(key_lock) != token:
+						pipe.reset()
+						return False
+					pipe.multi()
+					if release:
+						pipe.delete(key_lock)
+					else:
+						pipe.pexpire(key_lock, self.notify_lock_ttl * 1000)
+					pipe.execute()
+					return True
+				except redis.WatchError:
+					continue
+
+	# forget the base in the set of bases with queued notifications, unless
+	#   more were queued
+	# return False if there are queued notifications
+	def _end_notify(self, enc_base, key_notify):
+		while True:
+			with self.redis.pipeline() as pipe:
+				try:
+					pipe.watch(key_notify)
+					if pipe.execute_command('XLEN', key_notify) > 0:
+						pipe.reset()
 						return False
 					pipe.multi()
-					pipe.hset(key_notify_items, notify_props['id'], json.dumps(notify_props))
+					pipe.srem('%snotify-bases' % self.prefix, enc_base)
 					pipe.execute()
 					return True
 				except redis.WatchError:
 					continue
 
-	def _process_notify(self, base):
+	# publish the queued notifications of the base, in order. one process at
+	#   a time holds the publishing lock of a base, and keeps publishing until
+	#   the queue is empty, reading count entries at once. if another process
+	#   holds the lock, this returns at once and leaves the publishing to it.
+	#   entries left pending by a holder that went away (e.g. crashed) are
+	#   published first, once its lock has expired
+	# return total published
+	def process_notify(self, base, count=100):
+		enc_base = encode_id_part(base)
+		key_notify = '%s%s-notify-stream' % (self.prefix, enc_base)
+		key_lock = '%s%s-notify-lock' % (self.prefix, enc_base)
+		token = '%s-%s' % (self._get_notify_consumer(), uuid.uuid4().hex)
+
+		total = 0
+		while True:
+			if not self.redis.set(key_lock, token, px=self.notify_lock_ttl * 1000, nx=True):
+				break
+			try:
+				total += self._publish_notify_locked(enc_base, key_notify, key_lock, token, count)
+			finally:
+				self._renew_notify_lock(key_lock, token, release=True)
+
+			# writers that queued after the last read found the lock taken
+			#   and left their notifications to us
+			if self._end_notify(enc_base, key_notify):
+				break
+		return total
+
+	def _publish_notify_locked(self, enc_base, key_notify, key_lock, token, count):
+		total = 0
+		claiming = True
+		while True:
+			if claiming:
+				entries = self._claim_notify(key_notify, count)
+				if not entries:
+					claiming = False
+			if not claiming:
+				try:
+					entries = self._read_notify(key_notify, count)
+				except redis.ResponseError as e:
+					if not str(e).startswith('NOGROUP'):
+						raise
+					self._create_notify_group(key_notify)
+					entries = self._read_notify(key_notify, count)
+			if not entries:
+				return total
+
+			total += self._publish_notify_entries(enc_base, key_notify, entries)
+
+			# if the lock expired meanwhile, another process has taken over
+			if not self._renew_notify_lock(key_lock, token):
+				return total
+
+	def _publish_notify_entries(self, enc_base, key_notify, entries):
+		count = 0
+		for entry_id, fields in entries:
+			fields = dict(zip(fields[::2], fields[1::2]))
+			self._publish_notify(enc_base, json.loads(fields['props']))
+
+			# entries are removed once published, so the stream length is the backlog
+			with self.redis.pipeline() as pipe:
+				pipe.execute_command('XACK', key_notify, 'publishers', entry_id)
+				pipe.execute_command('XDEL', key_notify, entry_id)
+				pipe.execute()
+			count += 1
+		return count
+
+	# publish notifications queued by earlier versions, and any not yet
+	#   published. notifications left pending by a publisher that went away
+	#   are published once its lock has expired
+	# return total published
+	def recover_notify(self, base, count=100):
 		enc_base = encode_id_part(base)
+		key_notify = '%s%s-notify-stream' % (self.prefix, enc_base)
+
+		total = self._drain_legacy_notify(enc_base)
+
+		if self.redis.execute_command('XLEN', key_notify) > 0:
+			total += self.process_notify(base, count=count)
+		return total
+
+	# notifications queued by earlier versions, in the -notify list. pending
+	#   ones are published, without prev_cursor since the order relative to
+	#   newer writes is unknown. initializing ones are left for a minute, as
+	#   their writer may still be running, and then dropped. once the list
+	#   has been found empty, the base isn't checked again by this process
+	def _drain_legacy_notify(self, enc_base):
+		if enc_base in self.legacy_drained:
+			return 0
 		key_notify = '%s%s-notify' % (self.prefix, enc_base)
 		key_notify_items = '%s%s-notify-items' % (self.prefix, enc_base)
-		key_lastpub_created = '%s%s-lastpub-created' % (self.prefix, enc_base)
-		key_lastpub_modified = '%s%s-lastpub-modified' % (self.prefix, enc_base)
+		count = 0
 		while True:
 			with self.redis.pipeline() as pipe:
 				try:
 					pipe.watch(key_notify)
 					pipe.watch(key_notify_items)
-					pipe.watch(key_lastpub_created)
-					pipe.watch(key_lastpub_modified)
-
-					now = calendar.timegm(datetime.utcnow().utctimetuple())
-
 					id = pipe.lindex(key_notify, 0)
 					if not id:
-						# nothing to do
-						return
-
+						# whatever is left in the hash is unreachable
+						if pipe.exists(key_notify_items):
+							pipe.multi()
+							pipe.delete(key_notify_items)
+							pipe.execute()
+						self.legacy_drained.add(enc_base)
+						break
 					notify_props = pipe.hget(key_notify_items, id)
-					if not notify_props:
-						# nothing to do
-						return
-
-					notify_props = json.loads(notify_props)
-					if notify_props['state'] == 'initializing':
-						if notify_props['created'] + 60 > now:
-							# hopefully someone else will be taking care of this soon
-							return
-
-						# otherwise, eat the stale item and start over
-						pipe.multi()
-						pipe.lpop(key_notify)
-						pipe.execute()
-						continue
-
-					if 'cursor_created' in notify_props:
-						lastpub_created = pipe.get(key_lastpub_created)
-					if 'cursor_modified' in notify_props:
-						lastpub_modified = pipe.get(key_lastpub_modified)
-
+					if notify_props:
+						notify_props = json.loads(notify_props)
+						if notify_props.get('state') == 'initializing' and notify_props.get('created', 0) + 60 > calendar.timegm(datetime.utcnow().utctimetuple()):
+							# try again on a later pass
+							break
 					pipe.multi()
 					pipe.lpop(key_notify)
-					pipe.hdel(key_notify_items, notify_props['id'])
-					if 'cursor_created' in notify_props:
-						pipe.set(key_lastpub_created, notify_props['cursor_created'])
-					if 'cursor_modified' in notify_props:
-						pipe.set(key_lastpub_modified, notify_props['cursor_modified'])
+					pipe.hdel(key_notify_items, id)
 					pipe.execute()
-					break
 				except redis.WatchError:
 					continue
 
+			if not notify_props:
+				continue
+			if notify_props.get('state') != 'pending':
+				continue
+
+			cursors = dict()
+			for index in ('created', 'modified'):
+				if 'cursor_' + index in notify_props:
+					cursors[index] = notify_props['cursor_' + index]
+			notify_props['cursors'] = cursors
+			notify_props['prev_cursors'] = dict()
+			self._publish_notify(enc_base, notify_props)
+			count += 1
+
+		return count
+
+	def _publish_notify(self, enc_base, notify_props):
 		item = self._item_from_structured(notify_props['item'])
 
-		if 'cursor_created' in notify_props:
-			self.notify(enc_base + '-created', item, None, notify_props['cursor_created'], lastpub_created)
-		if 'cursor_modified' in notify_props:
-			self.notify(enc_base + '-modified', item, None, notify_props['cursor_modified'], lastpub_modified)
+		total = notify_props.get('total')
+		deleted_total = notify_props.get('deleted_total')
+
+		for index in ('created', 'modified', 'live'):
+			if index in notify_props['cursors']:
+				self.notify(enc_base + '-' + encode_id_part(index), item, total, notify_props['cursors'][index], notify_props['prev_cursors'].get(index), deleted_total=deleted_total)
+
+	# return number of notifications of the base not yet published
+	def get_notify_lag(self, base):
+		enc_base = encode_id_part(base)
+		key_notify = '%s%s-notify-stream' % (self.prefix, enc_base)
+		return self.redis.execute_command('XLEN', key_notify)
+
+	# the lastpub keys hold the cursor of the latest write to the published
+	#   orderings, so a client holding that cursor is caught up. writes never
+	#   insert before the latest one, and deletes and expiry only remove
+	def is_head(self, feed_id, cursor):
+		parts = feed_id.split('-')
+		base = decode_id_part(parts[0])
+		order = decode_id_part(parts[1])
+
+		if order not in ('created', 'modified', 'live'):
+			return False
+
+		lastpub = self.redis.get('%s%s-lastpub-%s' % (self.prefix, encode_id_part(base), order))
+		return (lastpub is not None and lastpub == cursor)
+
+	# the lastpub keys advance with every write, and apply to either
+	#   direction of an ordering
+	def get_heads(self, feed_ids):
+		keys = list()
+		for feed_id in feed_ids:
+			parts = feed_id.split('-')
+			base = decode_id_part(parts[0])
+			order = decode_id_part(parts[1])
+			if order.startswith('-'):
+				order = order[1:]
+			if order in ('created', 'modified', 'live'):
+				keys.append('%s%s-lastpub-%s' % (self.prefix, encode_id_part(base), order))
+			else:
+				keys.append(None)
+		values = self.redis.mget([k for k in keys if k is not None]) if any(keys) else []
+		out = list()
+		for key in keys:
+			if key is not None:
+				out.append(values.pop(0))
+			else:
+				out.append(None)
+		return out
 
-	def get_items(self, feed_id, since_spec, until_spec, max_count):
+	def get_items(self, feed_id, since_spec, until_spec, max_count, filters=None, cursors=False, fields=None):
 		parts = feed_id.split('-')
 		base = decode_id_part(parts[0])
 		order = decode_id_part(parts[1])
@@ -525,33 +1916,81 @@ class RedisModel(Model):
 			raise UnsupportedSpecError('Position spec not supported: %s' % until_spec.type)
 
 		enc_base = encode_id_part(base)
+		filter_keys = list()
+		if filters:
+			for name, value in filters.items():
+				if name not in self.filters:
+					raise UnsupportedSpecError('Filter not supported: %s' % name)
+				filter_keys.append(self._get_filter_key(enc_base, name, value))
+
+		if not filter_keys:
+			return self._get_items(enc_base, index, asc, since_spec, until_spec, max_count, cursors=cursors, fields=fields)
+
+		# filtered pages are read from the intersection of the index with the
+		#   filter sets, so positions and cursors are relative to the subset
+		key_filtered = '%s%s-filtered-%s' % (self.prefix, enc_base, uuid.uuid4())
+		try:
+			return self._get_items(enc_base, index, asc, since_spec, until_spec, max_count, cursors=cursors, filter_keys=filter_keys, key_filtered=key_filtered, fields=fields)
+		finally:
+			self.redis.delete(key_filtered)
+
+	def _get_items(self, enc_base, index, asc, since_spec, until_spec, max_count, cursors=False, filter_keys=None, key_filtered=None, fields=None):
 		key_items = '%s%s-items' % (self.prefix, enc_base)
 		key_index = '%s%s-index-%s' % (self.prefix, enc_base, index)
+		key_index_created = '%s%s-index-created' % (self.prefix, enc_base)
+		key_index_deleted = '%s%s-index-deleted' % (self.prefix, enc_base)
+		orig_since_spec = since_spec
+		orig_until_spec = until_spec
 		while True:
+			# a cursor spec may fall back to time below, so each attempt
+			#   starts from the specs as given
+			since_spec = copy.copy(orig_since_spec)
+			until_spec = copy.copy(orig_until_spec)
 			with self.redis.pipeline() as pipe:
 				try:
 					pipe.watch(key_items)
 					pipe.watch(key_index)
 
+					if filter_keys:
+						pipe.watch(*filter_keys)
+						# weights keep the index scores
+						weights = dict()
+						weights[key_index] = 1
+						for key in filter_keys:
+							weights[key] = 0
+						pipe.zinterstore(key_filtered, weights)
+						key_range = key_filtered
+					else:
+						key_range = key_index
+
 					try:
 						if since_spec:
-							since_ts, since_offset, since_cs = self._get_spec_parts(pipe, key_index, since_spec)
+							since_ts, since_offset, since_cs = self._get_spec_parts(pipe, key_range, since_spec)
 						if until_spec:
-							until_ts, until_offset, until_cs = self._get_spec_parts(pipe, key_index, until_spec)
+							until_ts, until_offset, until_cs = self._get_spec_parts(pipe, key_range, until_spec)
 					except:
 						raise InvalidSpecError()
 
 					# this is a loop so we can fallback from cursor to time
 					retry = False
 					while True:
+						# the range starts at the first item of the since timestamp, so
+						#   read past any items that will be trimmed off the front
+						skip = 0
+						if since_spec:
+							if since_spec.type == 'id':
+								skip = pipe.zcount(key_range, since_ts, since_ts)
+							elif since_spec.type == 'cursor' and since_offset is not None:
+								skip = since_offset + 1
+
 						if asc:
 							smin = since_ts if since_spec else '-inf'
 							smax = until_ts if until_spec else '+inf'
-							refs = pipe.zrangebyscore(key_index, smin, smax, start=0, num=max_count, withscores=True)
+							refs = pipe.zrangebyscore(key_range, smin, smax, start=0, num=max_count + skip, withscores=True)
 						else:
 							smax = since_ts if since_spec else '+inf'
 							smin = until_ts if until_spec else '-inf'
-							refs = pipe.zrevrangebyscore(key_index, smax, smin, start=0, num=max_count + 1, withscores=True)
+							refs = pipe.zrevrangebyscore(key_range, smax, smin, start=0, num=max_count + skip + 1, withscores=True)
 
 						tmp = list()
 						for ref in refs:
@@ -612,16 +2051,19 @@ class RedisModel(Model):
 					if not asc:
 						more = False
 						# if descending, we attempt to read one extra. did that work out?
-						if len(refs) > max_count:
+						if end - start > max_count:
 							more = True
 						elif until_spec:
 							# check and see if there's more after this timestamp
-							tmprefs = pipe.zrevrangebyscore(key_index, smin - 1, '-inf', start=0, num=1)
+							tmprefs = pipe.zrevrangebyscore(key_range, smin - 1, '-inf', start=0, num=1)
 							if len(tmprefs) > 0:
 								more = True
-						# now trim so we stay under the max
-						if end - start > max_count:
-							end = start + max_count
+
+					# now trim so we stay under the max. ascending reads can
+					#   overshoot too, when less of the since timestamp is
+					#   trimmed than was read past
+					if end - start > max_count:
+						end = start + max_count
 
 					if end - start <= 0:
 						out = ItemsResult()
@@ -636,11 +2078,11 @@ class RedisModel(Model):
 								elif since_spec.type == 'time':
 									if since_ts > 0:
 										# search for the first item before this time
-										refs = pipe.zrevrangebyscore(key_index, since_ts - 1, '-inf', start=0, num=1, withscores=True)
+										refs = pipe.zrevrangebyscore(key_range, since_ts - 1, '-inf', start=0, num=1, withscores=True)
 										if refs:
 											# now fetch all items within this timestamp and return a cursor for the last one
 											ts = refs[0][1]
-											item_ids = pipe.zrangebyscore(key_index, ts, ts)
+											item_ids = pipe.zrangebyscore(key_range, ts, ts)
 											if not refs:
 												# inconsistent, retry
 												continue
@@ -655,49 +2097,392 @@ class RedisModel(Model):
 									out.last_cursor = since_spec.value
 							else:
 								out.last_cursor = ''
+
+						pipe.multi()
+						pipe.zcard(key_index_created)
+						pipe.zcard(key_index_deleted)
+						ret = pipe.execute()
+						# totals are per base, so they don't apply to filtered pages
+						if not filter_keys:
+							out.total, out.deleted_total = self._get_totals(ret[0], ret[1])
 						return out
 
 					pipe.multi()
+					pipe.zcard(key_index_created)
+					pipe.zcard(key_index_deleted)
 					for n in range(start, end):
 						pipe.hget(key_items, refs[n][0])
 					ret = pipe.execute()
 
 					out = ItemsResult()
-					for data_raw in ret:
+					if not filter_keys:
+						out.total, out.deleted_total = self._get_totals(ret[0], ret[1])
+					entries = list()
+					for data_raw in ret[2:]:
 						if not data_raw:
 							# item went missing. restart operation
 							retry = True
 							break
-						item = self._item_deserialize(data_raw)
-						out.items.append(item)
+						entries.append(self._item_deserialize_ext(enc_base, data_raw))
 					if retry:
 						continue
+					if not self._load_large_fields(enc_base, entries, fields):
+						# item changed. restart operation
+						continue
+					for item, large in entries:
+						self._project(item, fields)
+						out.items.append(item)
 
 					if asc or more:
 						at = self._ref_rfind_first_score(refs, refs[end - 1][1])
 						assert(at != -1)
 						out.last_cursor = make_toc_cursor(refs[at][1], end - at - 1, self._get_ids(refs[at:end]))
 
+					if cursors:
+						# refs begin at the start of a timestamp, so offsets can
+						#   be counted from there
+						out.cursors = list()
+						at = 0
+						for n in range(end):
+							if refs[n][1] != refs[at][1]:
+								at = n
+							if n >= start:
+								out.cursors.append(make_toc_cursor(refs[n][1], n - at, self._get_ids(refs[at:n + 1])))
+
 					return out
 				except redis.WatchError:
 					continue
 
+	# ascending queries from a cursor or time, the usual refresh of a client,
+	#   are read for all feeds together in two round trips. anything else, or
+	#   anything that changes in between, goes through get_items
+	def get_items_batch(self, queries):
+		out = [None] * len(queries)
+		fast = list()
+		for n, (feed_id, since_spec, until_spec, max_count) in enumerate(queries):
+			parts = feed_id.split('-')
+			base = decode_id_part(parts[0])
+			order = decode_id_part(parts[1])
+			if order.startswith('-') or until_spec or (since_spec and since_spec.type not in ('time', 'cursor')):
+				continue
+			try:
+				if since_spec:
+					since_ts, since_offset, since_cs = self._get_spec_parts(self.redis, None, since_spec)
+				else:
+					since_ts, since_offset, since_cs = (None, None, None)
+			except:
+				# let get_items report it
+				continue
+			fast.append((n, encode_id_part(base), order, since_ts, since_offset, since_cs))
+
+		with self.redis.pipeline() as pipe:
+			for n, enc_base, index, since_ts, since_offset, since_cs in fast:
+				max_count = queries[n][3]
+				skip = (since_offset + 1) if since_offset is not None else 0
+				smin = since_ts if since_ts is not None else '-inf'
+				pipe.zrangebyscore('%s%s-index-%s' % (self.prefix, enc_base, index), smin, '+inf', start=0, num=max_count + skip, withscores=True)
+				pipe.zcard('%s%s-index-created' % (self.prefix, enc_base))
+				pipe.zcard('%s%s-index-deleted' % (self.prefix, enc_base))
+			ret = pipe.execute()
+
+		ranges = list()
+		for k, (n, enc_base, index, since_ts, since_offset, since_cs) in enumerate(fast):
+			refs = [(ref[0], int(ref[1])) for ref in ret[k * 3]]
+			start = 0
+			if since_offset is not None and len(refs) > 0 and refs[0][1] == since_ts:
+				if calc_toc_checksum(self._get_ids(refs[0:since_offset + 1])) != since_cs:
+					# cursor fallback is left to get_items
+					continue
+				start = since_offset + 1
+			# less may have been trimmed than was read past
+			refs = refs[:start + queries[n][3]]
+			result = ItemsResult()
+			result.total, result.deleted_total = self._get_totals(ret[k * 3 + 1], ret[k * 3 + 2])
+			ranges.append((n, enc_base, refs, start, result))
+
+		with self.redis.pipeline() as pipe:
+			for n, enc_base, refs, start, result in ranges:
+				for ref in refs[start:]:
+					pipe.hget('%s%s-items' % (self.prefix, enc_base), ref[0])
+			ret = pipe.execute()
+
+		at = 0
+		for n, enc_base, refs, start, result in ranges:
+			data = ret[at:at + len(refs) - start]
+			at += len(refs) - start
+			if not all(data):
+				# item went missing
+				continue
+			entries = [self._item_deserialize_ext(enc_base, data_raw) for data_raw in data]
+			if not self._load_large_fields(enc_base, entries):
+				# item changed
+				continue
+			for item, large in entries:
+				result.items.append(item)
+			if result.items:
+				first = self._ref_rfind_first_score(refs, refs[-1][1])
+				result.last_cursor = make_toc_cursor(refs[first][1], len(refs) - first - 1, self._get_ids(refs[first:]))
+			elif not queries[n][1]:
+				result.last_cursor = ''
+			elif queries[n][1].type == 'cursor':
+				result.last_cursor = queries[n][1].value
+			else:
+				# cursors for empty time queries are left to get_items
+				continue
+			out[n] = result
+
+		for n, q in enumerate(queries):
+			if out[n] is None:
+				out[n] = self.get_items(*q)
+		return out
+
+	# the composite cursor is the cursors of the feeds joined with '.', where
+	#   an empty part means no position in that feed yet. a feed nothing was
+	#   taken from after a since time keeps that time as its part
+	def get_merged_items(self, feed_ids, since_spec, until_spec, max_count, filters=None, fields=None):
+		orders = set()
+		for feed_id in feed_ids:
+			orders.add(decode_id_part(feed_id.split('-')[1]))
+		if len(orders) != 1:
+			raise SpecMismatchError('Merged feeds must have the same ordering')
+		asc = not orders.pop().startswith('-')
+
+		if since_spec and since_spec.type not in ('time', 'cursor'):
+			raise UnsupportedSpecError('Position spec not supported for merged feeds: %s' % since_spec.type)
+
+		if until_spec and until_spec.type != 'time':
+			raise UnsupportedSpecError('Position spec not supported for merged feeds: %s' % until_spec.type)
+
+		since_parts = [''] * len(feed_ids)
+		if since_spec and since_spec.type == 'cursor':
+			since_parts = since_spec.value.split('.')
+			if len(since_parts) != len(feed_ids):
+				raise InvalidSpecError()
+		elif since_spec and since_spec.type == 'time':
+			since_parts = [since_spec.value] * len(feed_ids)
+
+		results = list()
+		for n, feed_id in enumerate(feed_ids):
+			if '_' in since_parts[n]:
+				spec = PositionSpec('cursor', since_parts[n])
+			elif since_parts[n]:
+				spec = PositionSpec('time', since_parts[n])
+			else:
+				spec = None
+			results.append(self.get_items(feed_id, spec, copy.copy(until_spec), max_count, filters=filters, cursors=True, fields=fields))
+
+		# k-way merge on the timestamps of the item cursors
+		def feed_refs(n, result):
+			for at, cursor in enumerate(result.cursors or []):
+				ts = int(cursor.split('_')[0])
+				yield ((ts if asc else -ts), n, at)
+
+		merged = heapq.merge(*[feed_refs(n, result) for n, result in enumerate(results)])
+
+		out = ItemsResult()
+		taken = [0] * len(feed_ids)
+		for ref in merged:
+			if len(out.items) >= max_count:
+				break
+			n, at = ref[1], ref[2]
+			out.items.append(results[n].items[at])
+			taken[n] = at + 1
+
+		last_cursors = list()
+		more = False
+		for n, result in enumerate(results):
+			if taken[n] > 0:
+				last_cursors.append(result.cursors[taken[n] - 1])
+			elif asc and result.last_cursor is not None and not result.items:
+				last_cursors.append(result.last_cursor)
+			else:
+				# nothing taken, so stay where this page started
+				last_cursors.append(since_parts[n])
+			if taken[n] < len(result.items) or (not asc and result.last_cursor is not None):
+				more = True
+
+		# as with single feeds, a descending read without more items has no cursor
+		if asc or more:
+			out.last_cursor = '.'.join(last_cursors)
+
+		if all(result.total is not None for result in results):
+			out.total = sum(result.total for result in results)
+			out.deleted_total = sum(result.deleted_total for result in results)
+
+		return out
+
+	def get_snapshot(self, base, deleted=True, chunk_size=100):
+		enc_base = encode_id_part(base)
+		key_items = '%s%s-items' % (self.prefix, enc_base)
+		key_index_modified = '%s%s-index-modified' % (self.prefix, enc_base)
+		key_snapshot = '%s%s-snapshot-%s' % (self.prefix, enc_base, uuid.uuid4())
+
+		# copy the index in one step. item data read afterwards may be newer
+		#   than the copy, but any such change is also positioned after the
+		#   returned cursor, so clients syncing from it will see it again
+		with self.redis.pipeline() as pipe:
+			pipe.zunionstore(key_snapshot, [key_index_modified])
+			pipe.expire(key_snapshot, 3600)
+			pipe.execute()
+
+		try:
+			pos = 0
+			group_ts = None
+			group_ids = list()
+			while True:
+				refs = self.redis.zrange(key_snapshot, pos, pos + chunk_size - 1, withscores=True)
+				if not refs:
+					if pos == 0:
+						out = ItemsResult()
+						out.last_cursor = ''
+						yield out
+					break
+				pos += len(refs)
+
+				with self.redis.pipeline(transaction=False) as pipe:
+					pipe.expire(key_snapshot, 3600)
+					for ref in refs:
+						pipe.hget(key_items, ref[0])
+					ret = pipe.execute()[1:]
+
+				out = ItemsResult()
+				entries = list()
+				for ref, data_raw in zip(refs, ret):
+					ts = int(ref[1])
+					if ts != group_ts:
+						group_ts = ts
+						group_ids = list()
+					group_ids.append(ref[0])
+					if not data_raw:
+						# expired since the copy was made
+						continue
+					item, large = self._item_deserialize_ext(enc_base, data_raw)
+					if item.deleted and not deleted:
+						continue
+					entries.append((item, large))
+				# a record changed since it was read is read again
+				while not self._load_large_fields(enc_base, entries):
+					with self.redis.pipeline(transaction=False) as pipe:
+						for item, large in entries:
+							pipe.hget(key_items, item.id)
+						ret = pipe.execute()
+					entries = list()
+					for data_raw in ret:
+						if data_raw:
+							item, large = self._item_deserialize_ext(enc_base, data_raw)
+							if deleted or not item.deleted:
+								entries.append((item, large))
+				for item, large in entries:
+					out.items.append(item)
+				out.last_cursor = make_toc_cursor(group_ts, len(group_ids) - 1, group_ids)
+				yield out
+		finally:
+			self.redis.delete(key_snapshot)
+
+	def db_psh_sub_set(self, feed_id, uri):
+		self.redis.sadd('%spsh-subs-%s' % (self.prefix, encode_id_part(feed_id)), uri)
+
+	def db_psh_sub_remove(self, feed_id, uri):
+		self.redis.srem('%spsh-subs-%s' % (self.prefix, encode_id_part(feed_id)), uri)
+
+	def get_psh_subs(self, feed_id, cursor=0, count=100):
+		cursor, uris = self.redis.sscan('%spsh-subs-%s' % (self.prefix, encode_id_part(feed_id)), cursor, count=count)
+		return (int(cursor), uris)
+
+	# return (next scan cursor, list of bases). a next cursor of 0 means the
+	#   scan is complete
+	def get_bases(self, cursor=0, count=100):
+		key_bases = '%sbases' % self.prefix
+		cursor, enc_bases = self.redis.sscan(key_bases, cursor, count=count)
+		out = list()
+		for enc_base in enc_bases:
+			out.append(decode_id_part(enc_base))
+		return (int(cursor), out)
+
+	# bases with queued notifications
+	def get_notify_bases(self, cursor=0, count=100):
+		key_notify_bases = '%snotify-bases' % self.prefix
+		cursor, enc_bases = self.redis.sscan(key_notify_bases, cursor, count=count)
+		out = list()
+		for enc_base in enc_bases:
+			out.append(decode_id_part(enc_base))
+		return (int(cursor), out)
+
+	# bases are registered as items are added to them. this finds bases that
+	#   were written before the registry existed, and registers them
+	# return total registered
+	def register_bases(self, count=100):
+		key_bases = '%sbases' % self.prefix
+		suffix = '-index-created'
+		pattern = ''
+		for c in self.prefix:
+			if c in '*?[]\\':
+				pattern += '\\'
+			pattern += c
+		pattern += '*' + suffix
+		total = 0
+		cursor = 0
+		while True:
+			cursor, keys = self.redis.scan(cursor, match=pattern, count=count)
+			enc_bases = list()
+			for key in keys:
+				enc_bases.append(key[len(self.prefix):-len(suffix)])
+			if enc_bases:
+				total += self.redis.sadd(key_bases, *enc_bases)
+			if int(cursor) == 0:
+				break
+		return total
+
+	# remove the base from the registry if it has no items
+	# return True if removed
+	def unregister_base_if_empty(self, base):
+		enc_base = encode_id_part(base)
+		key_bases = '%sbases' % self.prefix
+		key_index_created = '%s%s-index-created' % (self.prefix, enc_base)
+		while True:
+			with self.redis.pipeline() as pipe:
+				try:
+					pipe.watch(key_index_created)
+					if pipe.zcard(key_index_created) > 0:
+						return False
+					pipe.multi()
+					pipe.srem(key_bases, enc_base)
+					pipe.execute()
+					return True
+				except redis.WatchError:
+					continue
+
 	# insert/update and return item
 	def add(self, base, data, id=None, notify=True):
 		enc_base = encode_id_part(base)
+		key_bases = '%sbases' % self.prefix
 		key_items = '%s%s-items' % (self.prefix, enc_base)
 		key_index_created = '%s%s-index-created' % (self.prefix, enc_base)
 		key_index_modified = '%s%s-index-modified' % (self.prefix, enc_base)
-		key_notify = '%s%s-notify' % (self.prefix, enc_base)
-		key_notify_items = '%s%s-notify-items' % (self.prefix, enc_base)
+		key_index_deleted = '%s%s-index-deleted' % (self.prefix, enc_base)
+		key_index_live = '%s%s-index-live' % (self.prefix, enc_base)
+		key_item_filters = '%s%s-item-filters' % (self.prefix, enc_base)
+		key_item_fields = '%s%s-item-fields' % (self.prefix, enc_base)
+		key_lastpub_created = '%s%s-lastpub-created' % (self.prefix, enc_base)
+		key_lastpub_modified = '%s%s-lastpub-modified' % (self.prefix, enc_base)
+		key_lastpub_live = '%s%s-lastpub-live' % (self.prefix, enc_base)
+		key_notify = '%s%s-notify-stream' % (self.prefix, enc_base)
+		key_moved = '%s%s-moved' % (self.prefix, enc_base)
 		while True:
 			with self.redis.pipeline() as pipe:
 				try:
 					pipe.watch(key_items)
 					pipe.watch(key_index_created)
 					pipe.watch(key_index_modified)
-					pipe.watch(key_notify)
-					pipe.watch(key_notify_items)
+					pipe.watch(key_index_deleted)
+					pipe.watch(key_index_live)
+					pipe.watch(key_lastpub_created)
+					pipe.watch(key_lastpub_modified)
+					pipe.watch(key_lastpub_live)
+					pipe.watch(key_moved)
+
+					if pipe.exists(key_moved):
+						raise BaseMovedError()
 
 					now = datetime.utcnow()
 
@@ -706,13 +2491,14 @@ class RedisModel(Model):
 
 					item = Item()
 					is_new = False
+					old_large = None
 					if id:
 						item.id = id
 
 						# look up existing item
 						cur_item_raw = pipe.hget(key_items, id)
 						if cur_item_raw:
-							cur_item = self._item_deserialize(cur_item_raw)
+							cur_item, old_large = self._item_deserialize_ext(enc_base, cur_item_raw)
 							item.created = cur_item.created
 							item.modified = cur_item.modified
 							item.deleted = cur_item.deleted
@@ -728,70 +2514,115 @@ class RedisModel(Model):
 
 					if is_new:
 						item.created = now
-						notify_created = True
-					else:
-						notify_created = False
 
-					notify_modified = True
 					item.modified = now
 
 					item.data = data
 
-					if notify:
-						notify_props = dict()
-						notify_props['id'] = str(uuid.uuid4())
-						notify_props['created'] = calendar.timegm(now.utctimetuple())
-						notify_props['state'] = 'initializing'
-
 					ts_created = calendar.timegm(item.created.utctimetuple())
 					ts_modified = calendar.timegm(item.modified.utctimetuple())
 
-					# save and retrieve position info in one shot
+					order_scores = dict()
+					for name, f in self.orderings.items():
+						score = f(item.data)
+						if score is not None:
+							score = int(score)
+						order_scores[name] = score
+
+					# the item hash is watched, so the stored filter refs can't
+					#   change underneath us
+					filter_refs = self._get_item_filter_refs(item.data)
+					old_filter_refs = list()
+					if not is_new:
+						old_filter_refs_raw = pipe.hget(key_item_filters, item.id)
+						if old_filter_refs_raw:
+							old_filter_refs = json.loads(old_filter_refs_raw)
+
+					# work out positions and totals ahead of the write. the keys
+					#   involved are watched, so these hold when it executes
+					cursors = dict()
+					prev_cursors = dict()
+					if is_new:
+						cursors['created'] = self._get_insert_cursor(ts_created, pipe.zrangebyscore(key_index_created, ts_created, ts_created), item.id)
+						prev_cursors['created'] = pipe.get(key_lastpub_created)
+						cursors['live'] = self._get_insert_cursor(ts_created, pipe.zrangebyscore(key_index_live, ts_created, ts_created), item.id)
+						prev_cursors['live'] = pipe.get(key_lastpub_live)
+					cursors['modified'] = self._get_insert_cursor(ts_modified, pipe.zrangebyscore(key_index_modified, ts_modified, ts_modified), item.id)
+					prev_cursors['modified'] = pipe.get(key_lastpub_modified)
+					count_created = pipe.zcard(key_index_created)
+					if is_new:
+						count_created += 1
+					total, deleted_total = self._get_totals(count_created, pipe.zcard(key_index_deleted))
+
+					record, large, large_values = self._item_split(item)
+					stale_refs = list()
+					for ref in self._get_large_field_refs(item.id, old_large):
+						if ref not in large_values:
+							stale_refs.append(ref)
+
 					pipe.multi()
-					pipe.hset(key_items, item.id, self._item_serialize(item))
+					pipe.hset(key_items, item.id, self._item_serialize(enc_base, record, large))
+					if stale_refs:
+						pipe.hdel(key_item_fields, *stale_refs)
+					if large_values:
+						pipe.hmset(key_item_fields, large_values)
 					pipe.zadd(key_index_created, item.id, ts_created)
 					pipe.zadd(key_index_modified, item.id, ts_modified)
-					pipe.zrangebyscore(key_index_created, ts_created, ts_created)
-					pipe.zrangebyscore(key_index_modified, ts_modified, ts_modified)
-					if notify:
-						pipe.rpush(key_notify, notify_props['id'])
-						pipe.hset(key_notify_items, notify_props['id'], json.dumps(notify_props))
-					ret = pipe.execute()
-					items_created = ret[3]
-					items_modified = ret[4]
+					if not item.deleted:
+						pipe.zadd(key_index_live, item.id, ts_created)
+					pipe.sadd(key_bases, enc_base)
+					for name, score in order_scores.items():
+						key_index = '%s%s-index-%s' % (self.prefix, enc_base, name)
+						if score is not None:
+							pipe.zadd(key_index, item.id, score)
+						else:
+							pipe.zrem(key_index, item.id)
+					for ref in old_filter_refs:
+						if ref not in filter_refs:
+							pipe.srem('%s%s-filter-%s' % (self.prefix, enc_base, ref), item.id)
+					for ref in filter_refs:
+						pipe.sadd('%s%s-filter-%s' % (self.prefix, enc_base, ref), item.id)
+					if filter_refs:
+						pipe.hset(key_item_filters, item.id, json.dumps(filter_refs))
+					elif old_filter_refs:
+						pipe.hdel(key_item_filters, item.id)
+					self._queue_notify(pipe, enc_base, key_notify, item, cursors, prev_cursors, total, deleted_total, notify)
+					pipe.execute()
 					break
 				except redis.WatchError:
 					continue
 
-		if notify:
-			notify_props['state'] = 'pending'
-			notify_props['item'] = self._item_to_structured(item)
-			if notify_created:
-				created_offset = items_created.index(item.id)
-				notify_props['cursor_created'] = make_toc_cursor(ts_created, created_offset, items_created[0:created_offset + 1])
-			if notify_modified:
-				modified_offset = items_modified.index(item.id)
-				notify_props['cursor_modified'] = make_toc_cursor(ts_modified, modified_offset, items_modified[0:modified_offset + 1])
-			self._rewrite_notify_props(base, notify_props)
-			self._process_notify(base)
+		if notify and self.inline_notify:
+			self.process_notify(base)
 
 		return item
 
 	def delete(self, base, id, notify=True):
 		enc_base = encode_id_part(base)
 		key_items = '%s%s-items' % (self.prefix, enc_base)
+		key_index_created = '%s%s-index-created' % (self.prefix, enc_base)
 		key_index_modified = '%s%s-index-modified' % (self.prefix, enc_base)
 		key_index_deleted = '%s%s-index-deleted' % (self.prefix, enc_base)
-		key_notify = '%s%s-notify' % (self.prefix, enc_base)
-		key_notify_items = '%s%s-notify-items' % (self.prefix, enc_base)
+		key_index_live = '%s%s-index-live' % (self.prefix, enc_base)
+		key_item_fields = '%s%s-item-fields' % (self.prefix, enc_base)
+		key_lastpub_modified = '%s%s-lastpub-modified' % (self.prefix, enc_base)
+		key_lastpub_live = '%s%s-lastpub-live' % (self.prefix, enc_base)
+		key_notify = '%s%s-notify-stream' % (self.prefix, enc_base)
+		key_moved = '%s%s-moved' % (self.prefix, enc_base)
 		while True:
 			with self.redis.pipeline() as pipe:
 				try:
 					pipe.watch(key_items)
+					pipe.watch(key_index_created)
 					pipe.watch(key_index_modified)
 					pipe.watch(key_index_deleted)
-					pipe.watch(key_notify)
-					pipe.watch(key_notify_items)
+					pipe.watch(key_index_live)
+					pipe.watch(key_lastpub_modified)
+					pipe.watch(key_lastpub_live)
+					pipe.watch(key_moved)
+
+					if pipe.exists(key_moved):
+						raise BaseMovedError()
 
 					now = datetime.utcnow()
 
@@ -802,56 +2633,66 @@ class RedisModel(Model):
 					if not item_raw:
 						raise ItemDoesNotExist()
 
-					item = self._item_deserialize(item_raw)
+					item, large = self._item_deserialize_ext(enc_base, item_raw)
 
 					if item.deleted:
 						raise ItemDoesNotExist()
 
+					# tombstones only keep the id and timestamps
 					item.deleted = True
 					item.modified = now
-
-					if notify:
-						notify_props = dict()
-						notify_props['id'] = str(uuid.uuid4())
-						notify_props['created'] = calendar.timegm(now.utctimetuple())
-						notify_props['state'] = 'initializing'
+					item.data = None
 
 					ts_modified = calendar.timegm(item.modified.utctimetuple())
 
-					# save and retrieve position info in one shot
+					# work out position and totals ahead of the write. the keys
+					#   involved are watched, so these hold when it executes
+					cursors = dict()
+					prev_cursors = dict()
+					cursors['modified'] = self._get_insert_cursor(ts_modified, pipe.zrangebyscore(key_index_modified, ts_modified, ts_modified), item.id)
+					prev_cursors['modified'] = pipe.get(key_lastpub_modified)
+					# the item leaves the live index rather than moving within
+					#   it, so the removal is published at the head of the live
+					#   feed, leaving it where it is
+					if pipe.zscore(key_index_live, item.id) is not None:
+						lastpub_live = pipe.get(key_lastpub_live)
+						if lastpub_live is not None:
+							cursors['live'] = lastpub_live
+							prev_cursors['live'] = lastpub_live
+					total, deleted_total = self._get_totals(pipe.zcard(key_index_created), pipe.zcard(key_index_deleted) + 1)
+
+					large_refs = self._get_large_field_refs(item.id, large)
+
 					pipe.multi()
-					pipe.hset(key_items, item.id, self._item_serialize(item))
+					pipe.hset(key_items, item.id, self._item_serialize(enc_base, item))
+					if large_refs:
+						pipe.hdel(key_item_fields, *large_refs)
 					pipe.zadd(key_index_modified, item.id, ts_modified)
 					pipe.zadd(key_index_deleted, item.id, ts_modified)
-					pipe.zrangebyscore(key_index_modified, ts_modified, ts_modified)
-					if notify:
-						pipe.rpush(key_notify, notify_props['id'])
-						pipe.hset(key_notify_items, notify_props['id'], json.dumps(notify_props))
-					ret = pipe.execute()
-					items_modified = ret[3]
+					pipe.zrem(key_index_live, item.id)
+					self._queue_notify(pipe, enc_base, key_notify, item, cursors, prev_cursors, total, deleted_total, notify)
+					pipe.execute()
 					break
 				except redis.WatchError:
 					continue
 
-		if notify:
-			notify_props['state'] = 'pending'
-			notify_props['item'] = self._item_to_structured(item)
-			modified_offset = items_modified.index(item.id)
-			notify_props['cursor_modified'] = make_toc_cursor(ts_modified, modified_offset, items_modified[0:modified_offset + 1])
-			self._rewrite_notify_props(base, notify_props)
-			self._process_notify(base)
+		if notify and self.inline_notify:
+			self.process_notify(base)
 
-	# ttl is in seconds
+	# ttl is in seconds. at most max_count items are cleared, if set
 	# return total cleared
-	def clear_expired(self, base, ttl, deleted=True):
+	def clear_expired(self, base, ttl, deleted=True, max_count=None):
 		ts_exp = calendar.timegm(datetime.utcnow().utctimetuple()) - ttl - 1
 		enc_base = encode_id_part(base)
 		key_items = '%s%s-items' % (self.prefix, enc_base)
 		key_index_created = '%s%s-index-created' % (self.prefix, enc_base)
 		key_index_modified = '%s%s-index-modified' % (self.prefix, enc_base)
 		key_index_deleted = '%s%s-index-deleted' % (self.prefix, enc_base)
+		key_index_live = '%s%s-index-live' % (self.prefix, enc_base)
+		key_item_filters = '%s%s-item-filters' % (self.prefix, enc_base)
+		key_item_fields = '%s%s-item-fields' % (self.prefix, enc_base)
 		total = 0
-		while True:
+		while max_count is None or total < max_count:
 			with self.redis.pipeline() as pipe:
 				try:
 					pipe.watch(key_items)
@@ -864,17 +2705,37 @@ class RedisModel(Model):
 					else:
 						key_index = key_index_modified
 
-					items = pipe.zrangebyscore(key_index, '-inf', ts_exp)
+					items = pipe.zrangebyscore(key_index, '-inf', ts_exp, start=0, num=1)
 					if not items:
 						break
 
 					item_id = items[0]
 
+					filter_refs = list()
+					filter_refs_raw = pipe.hget(key_item_filters, item_id)
+					if filter_refs_raw:
+						filter_refs = json.loads(filter_refs_raw)
+
+					# tombstones have no large fields
+					large_refs = list()
+					if not deleted:
+						item_raw = pipe.hget(key_items, item_id)
+						if item_raw:
+							large_refs = self._get_large_field_refs(item_id, self._item_deserialize_ext(enc_base, item_raw)[1])
+
 					pipe.multi()
 					pipe.hdel(key_items, item_id)
+					if large_refs:
+						pipe.hdel(key_item_fields, *large_refs)
 					pipe.zrem(key_index_created, item_id)
 					pipe.zrem(key_index_modified, item_id)
 					pipe.zrem(key_index_deleted, item_id)
+					pipe.zrem(key_index_live, item_id)
+					for name in self.orderings.keys():
+						pipe.zrem('%s%s-index-%s' % (self.prefix, enc_base, name), item_id)
+					for ref in filter_refs:
+						pipe.srem('%s%s-filter-%s' % (self.prefix, enc_base, ref), item_id)
+					pipe.hdel(key_item_filters, item_id)
 					pipe.execute()
 
 					total += 1
@@ -884,6 +2745,346 @@ class RedisModel(Model):
 					continue
 		return total
 
+# expires items of every base of a RedisModel, using the model's ttl for
+#   deleted items and item_ttl for the rest. work is done in batches, and
+#   throttled to at most rate items per second so that foreground requests
+#   are not starved
+class RedisSweeper(object):
+	def __init__(self, model, interval=60, batch_size=100, rate=1000):
+		self.model = model
+		self.interval = interval
+		self.batch_size = batch_size
+		self.rate = rate
+
+	def _clear(self, base, ttl, deleted):
+		total = 0
+		while True:
+			count = self.model.clear_expired(base, ttl, deleted=deleted, max_count=self.batch_size)
+			total += count
+			if count > 0 and self.rate:
+				time.sleep(float(count) / self.rate)
+			if count < self.batch_size:
+				break
+		return total
+
+	# return total cleared
+	def sweep_once(self):
+		total = 0
+		cursor = 0
+		while True:
+			cursor, bases = self.model.get_bases(cursor, count=self.batch_size)
+			for base in bases:
+				total += self._clear(base, self.model.ttl, True)
+				if self.model.item_ttl is not None:
+					total += self._clear(base, self.model.item_ttl, False)
+				self.model.unregister_base_if_empty(base)
+			if cursor == 0:
+				break
+		return total
+
+	def run(self):
+		self.model.register_bases()
+		while True:
+			start = time.time()
+			self.sweep_once()
+			elapsed = time.time() - start
+			if elapsed < self.interval:
+				time.sleep(self.interval - elapsed)
+
+# publishes queued notifications of every base of a RedisModel. any number
+#   of workers can run alongside each other. workers also recover
+#   notifications left behind by publishers that crashed, so at least one
+#   should run even if the model publishes inline
+class RedisNotifyWorker(object):
+	def __init__(self, model, interval=1, batch_size=100, recover_interval=60):
+		self.model = model
+		self.interval = interval
+		self.batch_size = batch_size
+		self.recover_interval = recover_interval
+		self.last_recover = None
+
+	# return total published
+	def process_once(self):
+		total = 0
+		cursor = 0
+		while True:
+			cursor, bases = self.model.get_notify_bases(cursor, count=self.batch_size)
+			for base in bases:
+				total += self.model.process_notify(base, count=self.batch_size)
+			if cursor == 0:
+				break
+
+		# every base is checked now and then for notifications queued by
+		#   earlier versions
+		now = time.time()
+		if self.last_recover is None or now >= self.last_recover + self.recover_interval:
+			self.last_recover = now
+			cursor = 0
+			while True:
+				cursor, bases = self.model.get_bases(cursor, count=self.batch_size)
+				for base in bases:
+					total += self.model.recover_notify(base, count=self.batch_size)
+				if cursor == 0:
+					break
+		return total
+
+	def run(self):
+		while True:
+			if self.process_once() == 0:
+				time.sleep(self.interval)
+
+# moves a base from one RedisModel to another (e.g. on a different Redis
+#   instance, or with a different prefix) while it is in use. copy scans
+#   every key of the base across in chunks. catch_up then copies the items
+#   written since the previous pass, until few are left. cutover stops
+#   writes to the source, copies the rest and removes items expired at the
+#   source meanwhile. ids and scores are copied exactly, so cursors held by
+#   clients and the prev_cursor chains of publishing stay valid. like
+#   is_head, this relies on writes never going back in time.
+# after cutover, writes to the source raise BaseMovedError, and the
+#   application should switch to the destination. purge then frees the
+#   source
+class RedisBaseMover(object):
+	def __init__(self, source, dest, base, chunk_size=500):
+		self.source = source
+		self.dest = dest
+		self.base = base
+		self.chunk_size = chunk_size
+		self.enc_base = encode_id_part(base)
+		# modified time from which items are yet to be copied
+		self.mark = None
+
+	def _src_key(self, name):
+		return '%s%s-%s' % (self.source.prefix, self.enc_base, name)
+
+	def _dest_key(self, name):
+		return '%s%s-%s' % (self.dest.prefix, self.enc_base, name)
+
+	def _get_indexes(self):
+		return ['created', 'modified', 'deleted', 'live'] + sorted(self.source.orderings.keys())
+
+	# return refs of all filter sets in use
+	def _get_filter_refs(self):
+		out = set()
+		cursor = 0
+		while True:
+			cursor, data = self.source.redis.hscan(self._src_key('item-filters'), cursor, count=self.chunk_size)
+			for refs in data.values():
+				out.update(json.loads(refs))
+			if int(cursor) == 0:
+				break
+		return sorted(out)
+
+	# return keys of the webhook subscriber sets of the feeds of the base
+	def _get_psh_sub_keys(self, prefix):
+		out = list()
+		for index in self._get_indexes():
+			for order in (index, '-' + index):
+				feed_id = self.enc_base + '-' + encode_id_part(order)
+				out.append('%spsh-subs-%s' % (prefix, encode_id_part(feed_id)))
+		return out
+
+	def _copy_hash(self, name):
+		cursor = 0
+		while True:
+			cursor, data = self.source.redis.hscan(self._src_key(name), cursor, count=self.chunk_size)
+			if data:
+				self.dest.redis.hmset(self._dest_key(name), data)
+			if int(cursor) == 0:
+				break
+
+	def _copy_zset(self, name):
+		cursor = 0
+		while True:
+			cursor, refs = self.source.redis.zscan(self._src_key(name), cursor, count=self.chunk_size)
+			if refs:
+				args = list()
+				for id, score in refs:
+					args.append(id)
+					args.append(int(score))
+				self.dest.redis.zadd(self._dest_key(name), *args)
+			if int(cursor) == 0:
+				break
+
+	def _copy_set(self, src_key, dest_key):
+		cursor = 0
+		while True:
+			cursor, members = self.source.redis.sscan(src_key, cursor, count=self.chunk_size)
+			if members:
+				self.dest.redis.sadd(dest_key, *members)
+			if int(cursor) == 0:
+				break
+
+	def _copy_strings(self):
+		names = ['zdict', 'lastpub-created', 'lastpub-modified', 'lastpub-live']
+		values = self.source.redis.mget([self._src_key(name) for name in names])
+		with self.dest.redis.pipeline() as pipe:
+			for name, value in zip(names, values):
+				if value is not None:
+					pipe.set(self._dest_key(name), value)
+				else:
+					pipe.delete(self._dest_key(name))
+			pipe.execute()
+
+	# copy the given items, with their positions in every index and their
+	#   filter sets, or remove them if they no longer exist at the source
+	def _copy_items(self, ids):
+		indexes = self._get_indexes()
+		with self.source.redis.pipeline() as pipe:
+			for id in ids:
+				pipe.hget(self._src_key('items'), id)
+				pipe.hget(self._src_key('item-filters'), id)
+				for index in indexes:
+					pipe.zscore(self._src_key('index-' + index), id)
+			ret = pipe.execute()
+
+		stride = 2 + len(indexes)
+
+		# large fields are listed by the records
+		large_refs = list()
+		for n, id in enumerate(ids):
+			data_raw = ret[n * stride]
+			if data_raw:
+				large_refs.append(self.source._get_large_field_refs(id, self.source._item_deserialize_ext(self.enc_base, data_raw)[1]))
+			else:
+				large_refs.append(list())
+		all_large_refs = [ref for refs in large_refs for ref in refs]
+		large_values = dict()
+		if all_large_refs:
+			large_values = dict(zip(all_large_refs, self.source.redis.hmget(self._src_key('item-fields'), all_large_refs)))
+
+		with self.dest.redis.pipeline() as pipe:
+			pipe.hmget(self._dest_key('item-filters'), ids)
+			pipe.hmget(self._dest_key('items'), ids)
+			old_filter_refs, old_records = pipe.execute()
+
+		with self.dest.redis.pipeline() as pipe:
+			for n, id in enumerate(ids):
+				data_raw = ret[n * stride]
+				filter_refs_raw = ret[n * stride + 1]
+				scores = ret[n * stride + 2:(n + 1) * stride]
+
+				old_refs = json.loads(old_filter_refs[n]) if old_filter_refs[n] else list()
+				refs = json.loads(filter_refs_raw) if (data_raw and filter_refs_raw) else list()
+
+				if data_raw:
+					pipe.hset(self._dest_key('items'), id, data_raw)
+				else:
+					pipe.hdel(self._dest_key('items'), id)
+				if old_records[n]:
+					stale = [ref for ref in self.dest._get_large_field_refs(id, self.dest._item_deserialize_ext(self.enc_base, old_records[n])[1]) if ref not in large_refs[n]]
+					if stale:
+						pipe.hdel(self._dest_key('item-fields'), *stale)
+				for ref in large_refs[n]:
+					if large_values[ref] is not None:
+						pipe.hset(self._dest_key('item-fields'), ref, large_values[ref])
+				for index, score in zip(indexes, scores):
+					if data_raw and score is not None:
+						pipe.zadd(self._dest_key('index-' + index), id, int(score))
+					else:
+						pipe.zrem(self._dest_key('index-' + index), id)
+				for ref in old_refs:
+					if ref not in refs:
+						pipe.srem(self._dest_key('filter-' + ref), id)
+				for ref in refs:
+					pipe.sadd(self._dest_key('filter-' + ref), id)
+				if refs:
+					pipe.hset(self._dest_key('item-filters'), id, filter_refs_raw)
+				else:
+					pipe.hdel(self._dest_key('item-filters'), id)
+			pipe.execute()
+
+	# bulk copy everything of the base
+	def copy(self):
+		# items modified from this second on are copied again by catch_up
+		top = self.source.redis.zrevrange(self._src_key('index-modified'), 0, 0, withscores=True)
+		self.mark = int(top[0][1]) if top else 0
+
+		# dictionaries first, so no copied record is unreadable
+		self._copy_hash('zdicts')
+		self._copy_hash('items')
+		self._copy_hash('item-fields')
+		self._copy_hash('item-filters')
+		for index in self._get_indexes():
+			self._copy_zset('index-' + index)
+		for ref in self._get_filter_refs():
+			self._copy_set(self._src_key('filter-' + ref), self._dest_key('filter-' + ref))
+		for src_key, dest_key in zip(self._get_psh_sub_keys(self.source.prefix), self._get_psh_sub_keys(self.dest.prefix)):
+			self._copy_set(src_key, dest_key)
+		self._copy_strings()
+		self.dest.redis.sadd('%sbases' % self.dest.prefix, self.enc_base)
+
+	# copy the items modified since the previous pass. return number copied
+	def catch_up(self):
+		refs = self.source.redis.zrangebyscore(self._src_key('index-modified'), self.mark, '+inf', withscores=True)
+		self._copy_hash('zdicts')
+		for n in range(0, len(refs), self.chunk_size):
+			self._copy_items([ref[0] for ref in refs[n:n + self.chunk_size]])
+		if refs:
+			self.mark = int(refs[-1][1])
+		return len(refs)
+
+	# remove items the source no longer has. return number removed
+	def _remove_expired(self):
+		total = 0
+		cursor = 0
+		while True:
+			cursor, refs = self.dest.redis.zscan(self._dest_key('index-created'), cursor, count=self.chunk_size)
+			with self.source.redis.pipeline(transaction=False) as pipe:
+				for ref in refs:
+					pipe.zscore(self._src_key('index-created'), ref[0])
+				scores = pipe.execute()
+			ids = [ref[0] for ref, score in zip(refs, scores) if score is None]
+			if ids:
+				self._copy_items(ids)
+				total += len(ids)
+			if int(cursor) == 0:
+				break
+		return total
+
+	# stop writes to the source and complete the copy
+	def cutover(self):
+		# writes watch this key, so none can complete at the source afterwards
+		self.source.redis.set(self._src_key('moved'), '1')
+
+		self.catch_up()
+		self._remove_expired()
+		self._copy_strings()
+		# subscriptions may have been removed too
+		for src_key, dest_key in zip(self._get_psh_sub_keys(self.source.prefix), self._get_psh_sub_keys(self.dest.prefix)):
+			self.dest.redis.delete(dest_key)
+			self._copy_set(src_key, dest_key)
+
+		# notifications not yet published at the source are published from
+		#   the destination. any being published right now may go out twice
+		key_notify = self._src_key('notify-stream')
+		for entry_id, fields in self.source.redis.execute_command('XRANGE', key_notify, '-', '+'):
+			self.dest.redis.execute_command('XADD', self._dest_key('notify-stream'), '*', *fields)
+			self.dest.redis.sadd('%snotify-bases' % self.dest.prefix, self.enc_base)
+		self.source.redis.delete(key_notify)
+		self.source.redis.srem('%snotify-bases' % self.source.prefix, self.enc_base)
+
+	# delete the base from the source, keeping only the moved marker
+	def purge(self):
+		keys = [self._src_key('filter-' + ref) for ref in self._get_filter_refs()]
+		keys.extend(self._get_psh_sub_keys(self.source.prefix))
+		for name in ('items', 'item-fields', 'item-filters', 'zdicts', 'zdict', 'lastpub-created', 'lastpub-modified', 'lastpub-live', 'notify-stream', 'notify-lock'):
+			keys.append(self._src_key(name))
+		for index in self._get_indexes():
+			keys.append(self._src_key('index-' + index))
+		# unlink frees large keys without blocking the server
+		for n in range(0, len(keys), self.chunk_size):
+			self.source.redis.execute_command('UNLINK', *keys[n:n + self.chunk_size])
+		self.source.redis.srem('%sbases' % self.source.prefix, self.enc_base)
+
+	# copy, catch up until a pass copies at most max_lag items, and cut over
+	def run(self, max_lag=100, max_passes=10):
+		self.copy()
+		for n in range(max_passes):
+			if self.catch_up() <= max_lag:
+				break
+		self.cutover()
+
 class ZrpcModel(Model):
 	# TODO
 	pass
@@ -1,26 +1,49 @@
+import os
 import threading
 import importlib
 from django.conf import settings
 import smartfeed
 
-tlocal = threading.local()
-
-def load_class(name):
+# loaded objects are shared by all threads of the process. they are only
+#   valid in the process that created them, since connections and publishing
+#   threads don't survive a fork, so a forked process loads its own
+loaded = dict()
+loaded_pid = None
+# reentrant, as loading an object may load others (e.g. its publisher)
+loaded_lock = threading.RLock()
+# guards starting over in a new process. it is never held while loading
+reset_lock = threading.Lock()
+
+def load_object(name):
 	at = name.rfind('.')
 	if at == -1:
-		raise ValueError('class name contains no \'.\'')
+		raise ValueError('object name contains no \'.\'')
 	module_name = name[0:at]
-	class_name = name[at + 1:]
-	return getattr(importlib.import_module(module_name), class_name)()
+	object_name = name[at + 1:]
+	return getattr(importlib.import_module(module_name), object_name)
+
+def load_class(name):
+	return load_object(name)()
 
-# load and keep in thread local storage
+# load once per process, and share
 def get_class(name):
-	if not hasattr(tlocal, 'loaded'):
-		tlocal.loaded = dict()
-	c = tlocal.loaded.get(name)
+	global loaded, loaded_pid, loaded_lock
+	pid = os.getpid()
+	if loaded_pid != pid:
+		with reset_lock:
+			if loaded_pid != pid:
+				# the fork may have happened while another thread held the lock
+				loaded_lock = threading.RLock()
+				loaded = dict()
+				# set last, as other threads check it without the lock
+				loaded_pid = pid
+	c = loaded.get(name)
 	if c is None:
-		c = load_class(name)
-		tlocal.loaded[name] = c
+		with loaded_lock:
+			c = loaded.get(name)
+			if c is None:
+				c = load_class(name)
+				loaded[name] = c
 	return c
 
 def get_class_from_setting(setting_name, default=None):
@@ -35,9 +58,27 @@ class Mapper(object):
 	def get_model_class(self, request, params):
 		return None
 
+	# return feed id, or a list of feed ids for a merged feed
 	def get_feed_id(self, request, params):
 		raise NotImplementedError()
 
+	def get_base(self, request, params):
+		raise NotImplementedError()
+
+	# return feed id for an entry of a batch request. raise ValueError if the
+	#   entry is not acceptable
+	def get_batch_feed_id(self, request, params, entry):
+		raise NotImplementedError()
+
+	# return dict of filter names to values, or None
+	def get_filters(self, request, params):
+		return None
+
+	# return list of the top-level fields of item data to return, or None
+	#   for all of them
+	def get_fields(self, request, params):
+		return None
+
 	def get_formatter(self, request, params):
 		# call the global method by default
 		return get_default_formatter()
@@ -47,28 +88,122 @@ class Mapper(object):
 		return get_grip_prefix()
 
 class DefaultMapper(Mapper):
+	# a 'bases' list in params makes a merged feed of those bases
 	def get_feed_id(self, request, params):
-		base = params['base']
 		order = request.GET.get('order')
 		if order is None:
 			order = 'created'
+		bases = params.get('bases')
+		if bases is not None:
+			out = list()
+			for base in bases:
+				out.append(smartfeed.encode_id_part(base) + '-' + smartfeed.encode_id_part(order))
+			return out
+		base = self.get_base(request, params)
 		return smartfeed.encode_id_part(base) + '-' + smartfeed.encode_id_part(order)
 
+	def get_base(self, request, params):
+		return params['base']
+
+	# entries may name a base, within the ones given in params if any
+	def get_batch_feed_id(self, request, params, entry):
+		order = entry.get('order')
+		if order is None:
+			order = 'created'
+		base = entry.get('base')
+		if base is None:
+			base = params.get('base')
+			if base is None:
+				raise ValueError('missing base')
+		elif 'bases' in params:
+			if base not in params['bases']:
+				raise ValueError('base not allowed')
+		elif 'base' in params:
+			if base != params['base']:
+				raise ValueError('base not allowed')
+		return smartfeed.encode_id_part(base) + '-' + smartfeed.encode_id_part(order)
+
+	# filters are given as filter=name:value, and may be repeated
+	def get_filters(self, request, params):
+		filters = dict()
+		for f in request.GET.getlist('filter'):
+			at = f.find(':')
+			if at < 1: # index 0 or not found
+				raise ValueError('missing name')
+			filters[f[:at]] = f[at + 1:]
+		return filters
+
+	# fields are given as a comma-separated list
+	def get_fields(self, request, params):
+		fields = request.GET.get('fields')
+		if fields is None:
+			return None
+		out = list()
+		for name in fields.split(','):
+			if not name:
+				raise ValueError('empty field name')
+			out.append(name)
+		return out
+
 class EpcpPublisher(smartfeed.EpcpPublisher):
 	def __init__(self):
-		pcs = smartfeed.PubControlSet()
+		pcs = smartfeed.PubControlSet(workers=getattr(settings, 'SMARTFEED_PUBLISH_WORKERS', 4))
 		if hasattr(settings, 'PUBLISH_SERVERS'):
 			pcs.apply_config(settings.PUBLISH_SERVERS)
 		if hasattr(settings, 'GRIP_PROXIES'):
 			pcs.apply_grip_config(settings.GRIP_PROXIES)
-		super(EpcpPublisher, self).__init__(pcs, prefix=get_grip_prefix(), formatter=get_default_formatter())
+		tracker = None
+		stats_specs = getattr(settings, 'SMARTFEED_PUSHPIN_STATS', None)
+		if stats_specs:
+			if not isinstance(stats_specs, list):
+				stats_specs = [stats_specs]
+			tracker = smartfeed.ChannelTracker()
+			for spec in stats_specs:
+				smartfeed.PushpinStatsListener(tracker, spec).start()
+		super(EpcpPublisher, self).__init__(pcs, prefix=get_grip_prefix(), formatter=get_default_formatter(), tracker=tracker)
+
+# also verifies subscriptions, so it has a worker even if delivery is off
+class WebhookDeliverer(smartfeed.WebhookDeliverer):
+	def __init__(self):
+		workers = getattr(settings, 'SMARTFEED_PSH_WORKERS', 0)
+		if workers < 1:
+			workers = 1
+		host_limit = getattr(settings, 'SMARTFEED_PSH_HOST_LIMIT', 2)
+		allowed_hosts = getattr(settings, 'SMARTFEED_PSH_ALLOWED_HOSTS', None)
+		max_pending = getattr(settings, 'SMARTFEED_PSH_MAX_PENDING', 10000)
+		super(WebhookDeliverer, self).__init__(workers=workers, host_limit=host_limit, allowed_hosts=allowed_hosts, max_pending=max_pending)
 
 class RedisModel(smartfeed.RedisModel):
 	def __init__(self):
 		host = getattr(settings, 'REDIS_HOST', 'localhost')
 		port = getattr(settings, 'REDIS_PORT', 6379)
 		db = getattr(settings, 'REDIS_DB', 0)
-		super(RedisModel, self).__init__(host=host, port=port, db=db, prefix=get_redis_prefix(), publisher=get_default_publisher())
+		ttl = getattr(settings, 'SMARTFEED_REDIS_TTL', None)
+		item_ttl = getattr(settings, 'SMARTFEED_REDIS_ITEM_TTL', None)
+		inline_notify = getattr(settings, 'SMARTFEED_REDIS_INLINE_NOTIFY', True)
+		item_compression = getattr(settings, 'SMARTFEED_REDIS_ITEM_COMPRESSION', False)
+		large_field_size = getattr(settings, 'SMARTFEED_REDIS_LARGE_FIELD_SIZE', None)
+		orderings = dict()
+		for name, f in getattr(settings, 'SMARTFEED_REDIS_ORDERINGS', dict()).items():
+			if not callable(f):
+				f = load_object(f)
+			orderings[name] = f
+		filters = dict()
+		for name, f in getattr(settings, 'SMARTFEED_REDIS_FILTERS', dict()).items():
+			if not callable(f):
+				f = load_object(f)
+			filters[name] = f
+		super(RedisModel, self).__init__(host=host, port=port, db=db, prefix=get_redis_prefix(), ttl=ttl, item_ttl=item_ttl, orderings=orderings, filters=filters, inline_notify=inline_notify, item_compression=item_compression, large_field_size=large_field_size)
+
+		# webhook delivery looks up subscribers in this model, so the
+		#   publisher is set up afterwards
+		publisher = get_default_publisher()
+		if getattr(settings, 'SMARTFEED_PSH_WORKERS', 0):
+			publisher = smartfeed.PublisherSet([publisher, smartfeed.PshPublisher(self, deliverer=get_webhook_deliverer(), formatter=get_default_formatter())])
+		publish_window = getattr(settings, 'SMARTFEED_PUBLISH_WINDOW', 0)
+		if publish_window:
+			publisher = smartfeed.CoalescingPublisher(publisher, window=publish_window)
+		self.publisher = publisher
 
 def get_default_mapper():
 	return get_class_from_setting('SMARTFEED_MAPPER_CLASS', 'smartfeed.django.DefaultMapper')
@@ -82,12 +217,28 @@ def get_default_publisher():
 def get_default_model():
 	return get_class_from_setting('SMARTFEED_MODEL_CLASS')
 
+def get_webhook_deliverer():
+	return get_class('smartfeed.django.WebhookDeliverer')
+
 def get_redis_prefix():
 	return getattr(settings, 'SMARTFEED_REDIS_PREFIX', 'smartfeed-')
 
 def get_grip_prefix():
 	return getattr(settings, 'SMARTFEED_GRIP_PREFIX', 'smartfeed-')
 
+def get_max_items():
+	return getattr(settings, 'SMARTFEED_MAX_ITEMS', 50)
+
+# pages larger than get_max_items() are streamed, up to this many items
+def get_streaming_max_items():
+	return getattr(settings, 'SMARTFEED_STREAMING_MAX_ITEMS', 0)
+
+def get_streaming_chunk_size():
+	return getattr(settings, 'SMARTFEED_STREAMING_CHUNK_SIZE', 50)
+
+def get_batch_max_feeds():
+	return getattr(settings, 'SMARTFEED_BATCH_MAX_FEEDS', 50)
+
 def check_grip_sig(request):
 	if not hasattr(settings, 'GRIP_PROXIES'):
 		return False
@@ -3,5 +3,7 @@ from django.conf.urls.defaults import patterns, url
 urlpatterns = patterns('smartfeed.django.app.views',
 	url(r'^items/$', 'items'),
 	url(r'^stream/$', 'stream'),
+	url(r'^snapshot/$', 'snapshot'),
+	url(r'^batch/$', 'batch'),
 	url(r'^subscriptions/$', 'subscriptions'),
 )
@@ -1,4 +1,8 @@
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed
+import itertools
+import json
+import urlparse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 import gripcontrol
 import smartfeed
 import smartfeed.django
@@ -21,6 +25,9 @@ def items(req, **kwargs):
 
 		feed_id = mapper.get_feed_id(req, kwargs)
 
+		# a list of feed ids is a merged feed
+		merged = isinstance(feed_id, list)
+
 		max_count = req.GET.get('max')
 		if max_count:
 			try:
@@ -30,8 +37,16 @@ def items(req, **kwargs):
 			except ValueError as e:
 				return HttpResponseBadRequest('Bad Request: Invalid max value: %s\n' % e.message)
 
-		if not max_count or max_count > 50:
-			max_count = 50
+		max_items = smartfeed.django.get_max_items()
+		streaming_max_items = smartfeed.django.get_streaming_max_items()
+		if not max_count:
+			max_count = max_items
+		elif max_count > max(max_items, streaming_max_items):
+			max_count = max(max_items, streaming_max_items)
+		if merged and max_count > max_items:
+			max_count = max_items
+
+		streaming = (max_count > max_items)
 
 		since = req.GET.get('since')
 		if since:
@@ -56,6 +71,22 @@ def items(req, **kwargs):
 		else:
 			wait = False
 
+		try:
+			filters = mapper.get_filters(req, kwargs)
+		except ValueError as e:
+			return HttpResponseBadRequest('Bad Request: Invalid filter value: %s\n' % e.message)
+
+		try:
+			fields = mapper.get_fields(req, kwargs)
+		except ValueError as e:
+			return HttpResponseBadRequest('Bad Request: Invalid fields value: %s\n' % e.message)
+
+		get_kwargs = dict()
+		if filters:
+			get_kwargs['filters'] = filters
+		if fields is not None:
+			get_kwargs['fields'] = fields
+
 		rformat = 'json'
 		accept = req.META.get('HTTP_ACCEPT')
 		if accept:
@@ -64,8 +95,36 @@ def items(req, **kwargs):
 			except:
 				pass
 
+		# long-polls from the head of the feed are the most common request, and
+		#   can be held without a range query
+		head = (wait and not merged and not filters and since and since.type == 'cursor' and not until)
+
+		# publishes carry whole items of single feeds with their own cursors,
+		#   so these are held on hint channels
+		hint = (merged or filters or fields is not None)
+		if merged:
+			hint_feed_ids = feed_id
+		else:
+			hint_feed_ids = [feed_id]
+
 		try:
-			result = model.get_items(feed_id, since, until, max_count)
+			# hint channels carry no position, so note where the feeds are
+			#   to tell if they move before the hold is set up
+			heads = None
+			if wait and hint:
+				heads = model.get_heads(hint_feed_ids)
+
+			if head and model.is_head(feed_id, since.value):
+				result = smartfeed.ItemsResult()
+				result.last_cursor = since.value
+			elif merged:
+				result = model.get_merged_items(feed_id, since, until, max_count, **get_kwargs)
+			elif streaming:
+				results = model.iter_items(feed_id, since, until, max_count, chunk_size=smartfeed.django.get_streaming_chunk_size(), **get_kwargs)
+				# fetch the first chunk up front, so errors and long-polls are handled as usual
+				result = next(results)
+			else:
+				result = model.get_items(feed_id, since, until, max_count, **get_kwargs)
 		except NotImplementedError as e:
 			return HttpResponse('Not Implemented: %s\n' % e.message, status=501)
 		except smartfeed.UnsupportedSpecError as e:
@@ -79,8 +138,17 @@ def items(req, **kwargs):
 		except smartfeed.ItemDoesNotExist as e:
 			return HttpResponseNotFound('Not Found: %s\n' % e.message)
 
-		if not wait or result.last_cursor is None or not since or len(result.items) > 0:
-			content_type, body = smartfeed.create_items_body(rformat, result.items, total=result.total, last_cursor=result.last_cursor, formatter=mapper.get_formatter(req, kwargs))
+		hold = (wait and result.last_cursor is not None and since and len(result.items) == 0)
+
+		# answer now if any of the feeds moved since the query
+		if hold and heads is not None and model.get_heads(hint_feed_ids) != heads:
+			hold = False
+
+		if not hold:
+			if streaming:
+				content_type, body = smartfeed.create_items_body_stream(rformat, itertools.chain([result], results), formatter=mapper.get_formatter(req, kwargs))
+				return StreamingHttpResponse(body, content_type=content_type)
+			content_type, body = smartfeed.create_items_body(rformat, result.items, total=result.total, last_cursor=result.last_cursor, formatter=mapper.get_formatter(req, kwargs), deleted_total=result.deleted_total)
 			return HttpResponse(body, content_type=content_type)
 
 		if not smartfeed.django.check_grip_sig(req):
@@ -88,7 +156,13 @@ def items(req, **kwargs):
 
 		grip_prefix = mapper.get_grip_prefix(req, kwargs)
 
-		channel = gripcontrol.Channel(grip_prefix + smartfeed.encode_id_part(feed_id) + '-' + smartfeed.encode_id_part(rformat), result.last_cursor)
+		if hint:
+			# have the proxy repeat the request when any of the feeds changes
+			channel = list()
+			for f in hint_feed_ids:
+				channel.append(gripcontrol.Channel(smartfeed.get_hint_channel(grip_prefix, f)))
+		else:
+			channel = gripcontrol.Channel(smartfeed.get_channel(grip_prefix, feed_id, rformat), result.last_cursor)
 		theaders = dict()
 		content_type, tbody = smartfeed.create_items_body(rformat, [], last_cursor=result.last_cursor)
 		theaders['Content-Type'] = content_type
@@ -121,7 +195,16 @@ def stream(req, **kwargs):
 
 		grip_prefix = mapper.get_grip_prefix(req, kwargs)
 
-		channel = gripcontrol.Channel(grip_prefix + smartfeed.encode_id_part(feed_id) + '-' + smartfeed.encode_id_part(rformat))
+		sse = ('text/event-stream' in [t.split(';')[0].strip() for t in req.META.get('HTTP_ACCEPT', '').split(',')])
+		if sse:
+			return _stream_sse(req, kwargs, mapper, feed_id, grip_prefix)
+
+		if isinstance(feed_id, list):
+			channel = list()
+			for f in feed_id:
+				channel.append(gripcontrol.Channel(smartfeed.get_channel(grip_prefix, f, rformat)))
+		else:
+			channel = gripcontrol.Channel(smartfeed.get_channel(grip_prefix, feed_id, rformat))
 		iheaders = dict()
 		iheaders['Content-Type'] = 'text/plain'
 		iresponse = gripcontrol.Response(headers=iheaders)
@@ -130,6 +213,294 @@ def stream(req, **kwargs):
 	else:
 		return HttpResponseNotAllowed(['GET'])
 
+# event ids are item cursors. a reconnecting client is sent the items it
+#   missed before the stream is held open, so it doesn't need to query
+#   items separately
+def _stream_sse(req, kwargs, mapper, feed_id, grip_prefix):
+	if isinstance(feed_id, list):
+		return HttpResponseBadRequest('Bad Request: Event streams of merged feeds not supported\n')
+
+	# events are published in ascending order only
+	parts = feed_id.split('-')
+	if len(parts) > 1 and smartfeed.decode_id_part(parts[1]).startswith('-'):
+		return HttpResponseBadRequest('Bad Request: Event streams of descending orders not supported\n')
+
+	model_class = kwargs.get('model_class')
+	if not model_class:
+		model_class = mapper.get_model_class(req, kwargs)
+	if model_class:
+		model = smartfeed.django.get_class(model_class)
+	else:
+		model = smartfeed.django.get_default_model()
+
+	# polyfills that can't set headers pass the id in the query string
+	last_event_id = req.META.get('HTTP_LAST_EVENT_ID')
+	if not last_event_id:
+		last_event_id = req.GET.get('lastEventId')
+
+	events = list()
+	complete = True
+	# the position the stream continues from, so the proxy can detect
+	#   publishes missed between the replay and the hold
+	prev_id = last_event_id or None
+	if last_event_id:
+		max_count = smartfeed.django.get_max_items()
+		try:
+			result = model.get_items(feed_id, smartfeed.parse_spec('cursor:' + last_event_id), None, max_count, cursors=True)
+		except NotImplementedError as e:
+			return HttpResponse('Not Implemented: %s\n' % e.message, status=501)
+		except smartfeed.UnsupportedSpecError as e:
+			return HttpResponseBadRequest('Bad Request: %s' % e.message)
+		except smartfeed.InvalidSpecError:
+			return HttpResponseBadRequest('Bad Request: Invalid spec\n')
+		except smartfeed.SpecMismatchError as e:
+			return HttpResponseBadRequest('Bad Request: %s' % e.message)
+		except smartfeed.FeedDoesNotExist as e:
+			return HttpResponseNotFound('Not Found: %s\n' % e.message)
+
+		formatter = mapper.get_formatter(req, kwargs)
+		for n, i in enumerate(result.items):
+			content = smartfeed.create_stream_content(i, result.total, result.cursors[n], prev_id, formatter=formatter, deleted_total=result.deleted_total)
+			events.append(smartfeed.create_sse_event(json.dumps(content), id=result.cursors[n]))
+			prev_id = result.cursors[n]
+
+		complete = (len(result.items) < max_count)
+
+	if not complete:
+		# more was missed than fits in one response. end it here, and the
+		#   client picks up from the last event when it reconnects
+		resp = HttpResponse(''.join(events), content_type='text/event-stream')
+		resp['Cache-Control'] = 'no-cache'
+		return resp
+
+	headers = dict()
+	headers['Content-Type'] = 'text/event-stream'
+	headers['Cache-Control'] = 'no-cache'
+	channel = gripcontrol.Channel(smartfeed.get_sse_channel(grip_prefix, feed_id), prev_id)
+	iresponse = gripcontrol.Response(headers=headers, body=''.join(events))
+	instruct = gripcontrol.create_hold_stream(channel, iresponse)
+	return HttpResponse(instruct, content_type='application/grip-instruct')
+
+def snapshot(req, **kwargs):
+	if req.method == 'GET':
+		mapper_class = kwargs.get('mapper_class')
+		if mapper_class:
+			mapper = smartfeed.django.get_class(mapper_class)
+		else:
+			mapper = smartfeed.django.get_default_mapper()
+
+		model_class = kwargs.get('model_class')
+		if not model_class:
+			model_class = mapper.get_model_class(req, kwargs)
+		if model_class:
+			model = smartfeed.django.get_class(model_class)
+		else:
+			model = smartfeed.django.get_default_model()
+
+		deleted = req.GET.get('deleted')
+		if deleted is not None:
+			if deleted in ('true', 'false'):
+				deleted = (deleted == 'true')
+			else:
+				return HttpResponseBadRequest('Bad Request: Invalid deleted value\n')
+		else:
+			deleted = True
+
+		rformat = 'json'
+		accept = req.META.get('HTTP_ACCEPT')
+		if accept:
+			try:
+				rformat = smartfeed.get_accept_format(accept)
+			except:
+				pass
+
+		try:
+			base = mapper.get_base(req, kwargs)
+			results = model.get_snapshot(base, deleted=deleted, chunk_size=smartfeed.django.get_streaming_chunk_size())
+			# fetch the first chunk up front, so errors are handled as usual
+			result = next(results)
+		except NotImplementedError as e:
+			return HttpResponse('Not Implemented: %s\n' % e.message, status=501)
+
+		content_type, body = smartfeed.create_items_body_stream(rformat, itertools.chain([result], results), formatter=mapper.get_formatter(req, kwargs))
+		accept_encoding = req.META.get('HTTP_ACCEPT_ENCODING', '')
+		gzip = ('gzip' in [e.split(';')[0].strip() for e in accept_encoding.split(',')])
+		if gzip:
+			body = smartfeed.gzip_body_stream(body)
+		resp = StreamingHttpResponse(body, content_type=content_type)
+		if gzip:
+			resp['Content-Encoding'] = 'gzip'
+		resp['Vary'] = 'Accept-Encoding'
+		return resp
+	else:
+		return HttpResponseNotAllowed(['GET'])
+
+# the request body is a json object with a 'feeds' list of entries, each
+#   having the base, order, since and max of an items request, and an
+#   optional 'wait'. the response has a 'feeds' list of items bodies
+@csrf_exempt
+def batch(req, **kwargs):
+	if req.method == 'POST':
+		mapper_class = kwargs.get('mapper_class')
+		if mapper_class:
+			mapper = smartfeed.django.get_class(mapper_class)
+		else:
+			mapper = smartfeed.django.get_default_mapper()
+
+		model_class = kwargs.get('model_class')
+		if not model_class:
+			model_class = mapper.get_model_class(req, kwargs)
+		if model_class:
+			model = smartfeed.django.get_class(model_class)
+		else:
+			model = smartfeed.django.get_default_model()
+
+		try:
+			params = json.loads(req.body)
+			entries = params['feeds']
+			if not isinstance(entries, list):
+				raise ValueError('feeds must be a list')
+		except (ValueError, KeyError, TypeError) as e:
+			return HttpResponseBadRequest('Bad Request: Invalid body: %s\n' % e)
+
+		if len(entries) > smartfeed.django.get_batch_max_feeds():
+			return HttpResponseBadRequest('Bad Request: Too many feeds\n')
+
+		wait = params.get('wait', False)
+		if not isinstance(wait, bool):
+			return HttpResponseBadRequest('Bad Request: Invalid wait value\n')
+
+		max_items = smartfeed.django.get_max_items()
+		queries = list()
+		for entry in entries:
+			if not isinstance(entry, dict):
+				return HttpResponseBadRequest('Bad Request: Invalid feed entry\n')
+
+			try:
+				feed_id = mapper.get_batch_feed_id(req, kwargs, entry)
+			except ValueError as e:
+				return HttpResponseBadRequest('Bad Request: Invalid feed entry: %s\n' % e.message)
+
+			max_count = entry.get('max')
+			if max_count is not None:
+				if not isinstance(max_count, (int, long)) or isinstance(max_count, bool) or max_count < 1:
+					return HttpResponseBadRequest('Bad Request: Invalid max value\n')
+				max_count = min(max_count, max_items)
+			else:
+				max_count = max_items
+
+			since = entry.get('since')
+			if since:
+				try:
+					since = smartfeed.parse_spec(since)
+				except ValueError as e:
+					return HttpResponseBadRequest('Bad Request: Invalid since value: %s\n' % e.message)
+
+			queries.append((feed_id, since, None, max_count))
+
+		try:
+			# the hold is on hint channels, which carry no position, so note
+			#   where the feeds are to tell if they move before it is set up
+			heads = None
+			if wait:
+				heads = model.get_heads([q[0] for q in queries])
+			results = model.get_items_batch(queries)
+		except NotImplementedError as e:
+			return HttpResponse('Not Implemented: %s\n' % e.message, status=501)
+		except smartfeed.UnsupportedSpecError as e:
+			return HttpResponseBadRequest('Bad Request: %s' % e.message)
+		except smartfeed.InvalidSpecError:
+			return HttpResponseBadRequest('Bad Request: Invalid spec\n')
+		except smartfeed.SpecMismatchError as e:
+			return HttpResponseBadRequest('Bad Request: %s' % e.message)
+		except smartfeed.FeedDoesNotExist as e:
+			return HttpResponseNotFound('Not Found: %s\n' % e.message)
+		except smartfeed.ItemDoesNotExist as e:
+			return HttpResponseNotFound('Not Found: %s\n' % e.message)
+
+		formatter = mapper.get_formatter(req, kwargs)
+		out = list()
+		for result in results:
+			out.append(smartfeed.create_items_body_json(result.items, total=result.total, last_cursor=result.last_cursor, formatter=formatter, deleted_total=result.deleted_total))
+		body = json.dumps({'feeds': out}, indent=4) + '\n'
+
+		# wait only if every feed is caught up
+		hold = wait and len(queries) > 0
+		for q, result in zip(queries, results):
+			if not q[1] or result.last_cursor is None or len(result.items) > 0:
+				hold = False
+		if hold and model.get_heads([q[0] for q in queries]) != heads:
+			hold = False
+
+		if not hold:
+			return HttpResponse(body, content_type='application/json')
+
+		if not smartfeed.django.check_grip_sig(req):
+			return HttpResponse('Error: Realtime endpoint not supported. Set up Pushpin or Fanout.io\n', status=501)
+
+		# the response covers all of the feeds, so have the proxy repeat the
+		#   request when any of them changes
+		grip_prefix = mapper.get_grip_prefix(req, kwargs)
+		channel = list()
+		for q in queries:
+			channel.append(gripcontrol.Channel(smartfeed.get_hint_channel(grip_prefix, q[0])))
+		theaders = dict()
+		theaders['Content-Type'] = 'application/json'
+		tresponse = gripcontrol.Response(headers=theaders, body=body)
+		instruct = gripcontrol.create_hold_response(channel, tresponse)
+		return HttpResponse(instruct, content_type='application/grip-instruct')
+	else:
+		return HttpResponseNotAllowed(['POST'])
+
+# PubSubHubbub (un)subscription. the request takes effect once the
+#   subscriber confirms it, which is asked in the background
+@csrf_exempt
 def subscriptions(req, **kwargs):
-	# TODO
-	return HttpResponse('Not Implemented: %s\n' % 'Persistent subscriptions not implemented', status=501)
+	if req.method == 'POST':
+		mapper_class = kwargs.get('mapper_class')
+		if mapper_class:
+			mapper = smartfeed.django.get_class(mapper_class)
+		else:
+			mapper = smartfeed.django.get_default_mapper()
+
+		model_class = kwargs.get('model_class')
+		if not model_class:
+			model_class = mapper.get_model_class(req, kwargs)
+		if model_class:
+			model = smartfeed.django.get_class(model_class)
+		else:
+			model = smartfeed.django.get_default_model()
+
+		feed_id = mapper.get_feed_id(req, kwargs)
+		if isinstance(feed_id, list):
+			return HttpResponseBadRequest('Bad Request: Subscriptions to merged feeds not supported\n')
+
+		mode = req.POST.get('hub.mode')
+		if mode not in ('subscribe', 'unsubscribe'):
+			return HttpResponseBadRequest('Bad Request: Invalid hub.mode value\n')
+
+		callback = req.POST.get('hub.callback')
+		if not callback or urlparse.urlsplit(callback).scheme not in ('http', 'https'):
+			return HttpResponseBadRequest('Bad Request: Invalid hub.callback value\n')
+
+		topic = req.POST.get('hub.topic')
+		if not topic:
+			topic = req.build_absolute_uri()
+
+		# fail now rather than after verifying
+		try:
+			model.get_psh_subs(feed_id, count=1)
+		except NotImplementedError as e:
+			return HttpResponse('Not Implemented: %s\n' % e.message, status=501)
+
+		def on_verified():
+			if mode == 'subscribe':
+				model.psh_sub_set(feed_id, callback)
+			else:
+				model.psh_sub_remove(feed_id, callback)
+
+		if not smartfeed.django.get_webhook_deliverer().verify(callback, mode, topic, on_verified):
+			return HttpResponse('Service Unavailable: Too many pending webhook requests\n', status=503)
+		return HttpResponse(status=202)
+	else:
+		return HttpResponseNotAllowed(['POST'])
@@ -1,24 +1,1179 @@
 import sys
+import os
 import json
-import smartfeed.django
-
-base = sys.argv[1]
-command = sys.argv[2]
-
-db = smartfeed.django.get_default_model()
-
-if command == 'add':
-	data = json.loads(sys.argv[3])
-	id = sys.argv[4] if len(sys.argv) >= 5 else None
-	db.add(base, data, id=id)
-elif command == 'del':
-	id = sys.argv[3]
-	db.delete(base, id)
-elif command == 'exp':
-	ttl = int(sys.argv[3])
-	db.clear_expired(base, ttl)
-elif command == 'expany':
-	ttl = int(sys.argv[3])
-	db.clear_expired(base, ttl, deleted=False)
-else:
-	raise ValueError('unsupported command')
+import time
+import random
+import threading
+import argparse
+import unittest
+import urlparse
+from datetime import datetime
+import BaseHTTPServer
+import SocketServer
+import smartfeed
+
+def usage():
+	print 'usage: test.py {base} add {json} [id]'
+	print '       test.py {base} del {id}'
+	print '       test.py {base} exp|expany {ttl}'
+	print '       test.py {base} lag'
+	print '       test.py {base} move {host} {port} {db} [prefix]'
+	print '       test.py sweep'
+	print '       test.py notify'
+	print '       test.py load [options] (see test.py load --help)'
+	print '       test.py check [unittest options]'
+	sys.exit(1)
+
+def run_command(args):
+	import smartfeed.django
+
+	db = smartfeed.django.get_default_model()
+
+	if args[0] == 'sweep':
+		smartfeed.RedisSweeper(db).run()
+		return
+	elif args[0] == 'notify':
+		smartfeed.RedisNotifyWorker(db).run()
+		return
+
+	if len(args) < 2:
+		usage()
+
+	base = args[0]
+	command = args[1]
+
+	if command == 'add':
+		data = json.loads(args[2])
+		id = args[3] if len(args) >= 4 else None
+		db.add(base, data, id=id)
+	elif command == 'del':
+		id = args[2]
+		db.delete(base, id)
+	elif command == 'exp':
+		ttl = int(args[2])
+		db.clear_expired(base, ttl)
+	elif command == 'expany':
+		ttl = int(args[2])
+		db.clear_expired(base, ttl, deleted=False)
+	elif command == 'lag':
+		print db.get_notify_lag(base)
+	elif command == 'move':
+		prefix = args[5] if len(args) >= 6 else db.prefix
+		dest = smartfeed.RedisModel(host=args[2], port=int(args[3]), db=int(args[4]), prefix=prefix, orderings=db.orderings, filters=db.filters)
+		smartfeed.RedisBaseMover(db, dest, base).run()
+	else:
+		raise ValueError('unsupported command')
+
+# collects timings of each kind of operation
+class Stats(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.samples = dict()
+		self.errors = dict()
+		self.counts = dict()
+
+	def add(self, name, value):
+		with self.lock:
+			self.samples.setdefault(name, list()).append(value)
+
+	def error(self, name):
+		with self.lock:
+			self.errors[name] = self.errors.get(name, 0) + 1
+
+	# for events that have no duration
+	def count(self, name):
+		with self.lock:
+			self.counts[name] = self.counts.get(name, 0) + 1
+
+	def report(self, duration):
+		names = sorted(set(self.samples.keys()) | set(self.errors.keys()))
+		print '%-16s %8s %8s %8s %8s %8s %8s %8s' % ('', 'count', 'errors', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+		for name in names:
+			values = sorted(self.samples.get(name, list()))
+			line = '%-16s %8d %8d %8.1f' % (name, len(values), self.errors.get(name, 0), len(values) / duration)
+			if values:
+				line += ' %8.2f %8.2f %8.2f %8.2f' % (percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000, percentile(values, 0.99) * 1000, values[-1] * 1000)
+			print line
+		for name in sorted(self.counts.keys()):
+			print '%-16s %8d %8s %8.1f' % (name, self.counts[name], '', self.counts[name] / duration)
+
+def percentile(values, p):
+	return values[int(round(p * (len(values) - 1)))]
+
+# local http server standing in for a remote endpoint. handle is called
+#   with the method, path and body of each request, and returns the
+#   response status and body
+class StandIn(object):
+	def __init__(self, handle):
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def log_message(self, format, *args):
+				pass
+
+			def respond(self):
+				body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				status, rbody = handle(self.command, self.path, body)
+				self.send_response(status)
+				self.send_header('Content-Length', str(len(rbody)))
+				self.end_headers()
+				self.wfile.write(rbody)
+
+			do_GET = respond
+			do_POST = respond
+
+		class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+			daemon_threads = True
+
+		self.server = Server(('127.0.0.1', 0), Handler)
+		self.uri = 'http://127.0.0.1:%d' % self.server.server_address[1]
+		t = threading.Thread(target=self.server.serve_forever)
+		t.daemon = True
+		t.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+# stands in for the GRIP proxy's control endpoint. items published to json
+#   channels are matched with the time their write started, to measure
+#   end-to-end publish lag
+class PublishCapture(object):
+	def __init__(self, stats):
+		self.stats = stats
+		self.lock = threading.Lock()
+		# item id -> write start time
+		self.writes = dict()
+		self.server = StandIn(self.handle)
+		self.uri = self.server.uri
+
+	def handle(self, method, path, body):
+		self.received(time.time(), json.loads(body))
+		return (200, '')
+
+	def wrote(self, id, start):
+		with self.lock:
+			self.writes[id] = start
+
+	def received(self, now, data):
+		for i in data.get('items', list()):
+			if not i.get('channel', '').endswith('-json'):
+				continue
+			self.stats.count('publish')
+			body = json.loads(i['http-response']['body'])
+			for item in body['items']:
+				with self.lock:
+					start = self.writes.pop(item['id'], None)
+				if start is not None:
+					self.stats.add('publish lag', now - start)
+
+def load(args):
+	parser = argparse.ArgumentParser(prog='test.py load', description='Drive the Redis model and the Django views with a mix of traffic, capturing publishes with a local stand-in for the GRIP control endpoint.')
+	parser.add_argument('--duration', type=float, default=10, help='seconds to run (default 10)')
+	parser.add_argument('--writers', type=int, default=2, help='threads adding and deleting items (default 2)')
+	parser.add_argument('--write-rate', type=float, default=0, help='writes per second per writer, 0 for no limit (default 0)')
+	parser.add_argument('--delete-ratio', type=float, default=0.1, help='fraction of writes that delete an item (default 0.1)')
+	parser.add_argument('--pollers', type=int, default=2, help='threads querying items from the start of a feed (default 2)')
+	parser.add_argument('--long-pollers', type=int, default=2, help='threads querying items with wait=true from the last cursor (default 2)')
+	parser.add_argument('--expirers', type=int, default=0, help='threads clearing expired items (default 0)')
+	parser.add_argument('--expire-ttl', type=int, default=60, help='ttl used by expirers, in seconds (default 60)')
+	parser.add_argument('--bases', type=int, default=10, help='number of bases written to (default 10)')
+	parser.add_argument('--max', type=int, default=50, help='max items per query (default 50)')
+	parser.add_argument('--prefix', default='smartfeed-load-', help='redis key prefix, existing keys under it are removed, so it may not be empty (default smartfeed-load-)')
+	options = parser.parse_args(args)
+	if not options.prefix:
+		# every key would be removed
+		parser.error('--prefix must not be empty')
+
+	from django.conf import settings
+	if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+		settings.configure()
+
+	import jwt
+	import redis
+	from django.test.client import RequestFactory
+	import smartfeed.django
+	from smartfeed.django.app import views
+
+	stats = Stats()
+	capture = PublishCapture(stats)
+
+	grip_key = 'loadtest'
+	settings.GRIP_PROXIES = [{'key': grip_key, 'control_uri': capture.uri}]
+	settings.SMARTFEED_MODEL_CLASS = 'smartfeed.django.RedisModel'
+	settings.SMARTFEED_REDIS_PREFIX = options.prefix
+	settings.SMARTFEED_MAX_ITEMS = max(options.max, getattr(settings, 'SMARTFEED_MAX_ITEMS', 50))
+	settings.ALLOWED_HOSTS = ['*']
+
+	r = redis.Redis(host=getattr(settings, 'REDIS_HOST', 'localhost'), port=getattr(settings, 'REDIS_PORT', 6379), db=getattr(settings, 'REDIS_DB', 0))
+	keys = r.keys(options.prefix.replace('*', '\\*') + '*')
+	if keys:
+		r.delete(*keys)
+
+	bases = ['load%d' % n for n in range(options.bases)]
+	rf = RequestFactory()
+	end = time.time() + options.duration
+	ids = dict()
+	ids_lock = threading.Lock()
+
+	def timed(name, f):
+		start = time.time()
+		try:
+			ret = f()
+		except Exception:
+			stats.error(name)
+			return None
+		stats.add(name, time.time() - start)
+		return ret
+
+	def writer():
+		model = smartfeed.django.get_default_model()
+		next_write = time.time()
+		while time.time() < end:
+			base = random.choice(bases)
+			delete_id = None
+			if random.random() < options.delete_ratio:
+				with ids_lock:
+					if ids.get(base):
+						delete_id = ids[base].pop(random.randrange(len(ids[base])))
+			if delete_id:
+				capture.wrote(delete_id, time.time())
+				timed('delete', lambda: model.delete(base, delete_id))
+			else:
+				id = os.urandom(8).encode('hex')
+				capture.wrote(id, time.time())
+				if timed('add', lambda: model.add(base, {'n': random.randint(0, 1000000)}, id=id)) is not None:
+					with ids_lock:
+						ids.setdefault(base, list()).append(id)
+			if options.write_rate > 0:
+				next_write += 1.0 / options.write_rate
+				delay = next_write - time.time()
+				if delay > 0:
+					time.sleep(delay)
+
+	def poller():
+		while time.time() < end:
+			req = rf.get('/items/', {'max': str(options.max)})
+			resp = timed('poll', lambda: views.items(req, base=random.choice(bases)))
+			if resp is not None and resp.status_code != 200:
+				stats.error('poll')
+
+	def long_poller():
+		cursors = dict()
+		while time.time() < end:
+			base = random.choice(bases)
+			params = {'max': str(options.max), 'wait': 'true'}
+			if base in cursors:
+				params['since'] = 'cursor:' + cursors[base]
+			grip_sig = jwt.encode({'iss': 'loadtest', 'exp': int(time.time()) + 3600}, grip_key)
+			req = rf.get('/items/', params, HTTP_GRIP_SIG=grip_sig)
+			resp = timed('long-poll', lambda: views.items(req, base=base))
+			if resp is None:
+				continue
+			if resp.status_code != 200:
+				stats.error('long-poll')
+			elif resp['Content-Type'] == 'application/grip-instruct':
+				stats.count('long-poll hold')
+			else:
+				cursor = json.loads(resp.content).get('last_cursor')
+				if cursor:
+					cursors[base] = cursor
+
+	def expirer():
+		model = smartfeed.django.get_default_model()
+		while time.time() < end:
+			for base in bases:
+				timed('expire', lambda: model.clear_expired(base, options.expire_ttl))
+			time.sleep(1)
+
+	threads = list()
+	for f, count in ((writer, options.writers), (poller, options.pollers), (long_poller, options.long_pollers), (expirer, options.expirers)):
+		for n in range(count):
+			threads.append(threading.Thread(target=f))
+	start = time.time()
+	for t in threads:
+		t.daemon = True
+		t.start()
+	for t in threads:
+		t.join()
+	duration = time.time() - start
+
+	# give publishes in flight a moment to arrive
+	time.sleep(1)
+
+	model = smartfeed.django.get_default_model()
+	lag = 0
+	for base in bases:
+		lag += model.get_notify_lag(base)
+
+	print 'ran %.1fs with %d writers, %d pollers, %d long-pollers, %d expirers over %d bases' % (duration, options.writers, options.pollers, options.long_pollers, options.expirers, len(bases))
+	stats.report(duration)
+	print 'notifications not yet published: %d' % lag
+
+	# publishing threads would otherwise be waited for at exit
+	sys.stdout.flush()
+	os._exit(0)
+
+# checks run against the local redis, under a prefix of their own whose
+#   keys are removed before each one
+class ModelTestCase(unittest.TestCase):
+	prefix = 'smartfeed-check-'
+
+	def setUp(self):
+		self.model = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix)
+		self.clear()
+
+	def clear(self):
+		keys = self.model.redis.keys(self.prefix + '*')
+		if keys:
+			self.model.redis.delete(*keys)
+
+	# items written within the same second share a timestamp. set it
+	#   explicitly, so results don't depend on timing
+	def add_at(self, base, ids, ts):
+		key_index = '%s%s-index-created' % (self.prefix, smartfeed.encode_id_part(base))
+		for id in ids:
+			self.model.add(base, {'id': id}, id=id, notify=False)
+			self.model.redis.zadd(key_index, id, ts)
+
+class GetItemsTest(ModelTestCase):
+	def test_since_id_within_timestamp(self):
+		self.add_at('a', ['1', '2', '3', '4', '5'], 1000)
+		result = self.model.get_items('a-created', smartfeed.PositionSpec('id', '2'), None, 2)
+		self.assertEqual([i.id for i in result.items], ['3', '4'])
+		result = self.model.get_items('a-created', smartfeed.PositionSpec('cursor', result.last_cursor), None, 2)
+		self.assertEqual([i.id for i in result.items], ['5'])
+
+	def test_since_cursor_of_expired_timestamp(self):
+		self.add_at('a', ['1', '2', '3', '4', '5'], 2000)
+		# nothing is left at the cursor's timestamp, so the range starts at
+		#   the first item after it
+		cursor = smartfeed.make_toc_cursor(1000, 5, ['x', 'x', 'x', 'x', 'x', 'x'])
+		result = self.model.get_items('a-created', smartfeed.PositionSpec('cursor', cursor), None, 2)
+		self.assertEqual([i.id for i in result.items], ['1', '2'])
+		result = self.model.get_items('a-created', smartfeed.PositionSpec('cursor', result.last_cursor), None, 2)
+		self.assertEqual([i.id for i in result.items], ['3', '4'])
+
+	def test_merged_since_time(self):
+		self.add_at('a', ['a1', 'a2', 'a3'], 2000)
+		self.add_at('b', ['b0'], 500)
+		self.add_at('b', ['b1', 'b2'], 3000)
+		since = smartfeed.PositionSpec('time', '1970-01-01T00:16:40')
+		result = self.model.get_merged_items(['a-created', 'b-created'], since, None, 3)
+		self.assertEqual([i.id for i in result.items], ['a1', 'a2', 'a3'])
+		# b was read, but none of it taken. it must not restart from the
+		#   beginning, before the since time
+		result = self.model.get_merged_items(['a-created', 'b-created'], smartfeed.PositionSpec('cursor', result.last_cursor), None, 3)
+		self.assertEqual([i.id for i in result.items], ['b1', 'b2'])
+
+	def test_merged_since_time_descending(self):
+		self.add_at('a', ['a1', 'a2', 'a3'], 4000)
+		self.add_at('b', ['b1', 'b2'], 3000)
+		self.add_at('b', ['b3'], 6000)
+		since = smartfeed.PositionSpec('time', '1970-01-01T01:23:20')
+		feed_ids = ['a-\\x2dcreated', 'b-\\x2dcreated']
+		result = self.model.get_merged_items(feed_ids, since, None, 3)
+		self.assertEqual([i.id for i in result.items], ['a3', 'a2', 'a1'])
+		# b must not restart from its head, after the since time
+		result = self.model.get_merged_items(feed_ids, smartfeed.PositionSpec('cursor', result.last_cursor), None, 3)
+		self.assertEqual([i.id for i in result.items], ['b2', 'b1'])
+
+	def test_batch_since_cursor_of_expired_timestamp(self):
+		self.add_at('a', ['1', '2', '3', '4', '5'], 2000)
+		cursor = smartfeed.make_toc_cursor(1000, 5, ['x', 'x', 'x', 'x', 'x', 'x'])
+		result = self.model.get_items_batch([('a-created', smartfeed.PositionSpec('cursor', cursor), None, 2)])[0]
+		self.assertEqual([i.id for i in result.items], ['1', '2'])
+		result = self.model.get_items_batch([('a-created', smartfeed.PositionSpec('cursor', result.last_cursor), None, 2)])[0]
+		self.assertEqual([i.id for i in result.items], ['3', '4'])
+
+	def test_batch_since_cursor_checksum_mismatch(self):
+		self.add_at('a', ['1', '2', '3'], 1000)
+		self.add_at('a', ['4'], 2000)
+		# an item before the cursor went away, so the cursor falls back to time
+		cursor = smartfeed.make_toc_cursor(1000, 1, ['0', '1'])
+		since = smartfeed.PositionSpec('cursor', cursor)
+		expected = self.model.get_items('a-created', since, None, 2)
+		result = self.model.get_items_batch([('a-created', since, None, 2)])[0]
+		self.assertEqual([i.id for i in result.items], [i.id for i in expected.items])
+		self.assertEqual(result.last_cursor, expected.last_cursor)
+
+@unittest.skipIf(smartfeed.zstandard is None, 'zstandard not installed')
+class CompressionTest(ModelTestCase):
+	def setUp(self):
+		super(CompressionTest, self).setUp()
+		self.compressing = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix, item_compression=True)
+
+	def get_record(self, id):
+		return self.model.redis.hget(self.prefix + 'a-items', id)
+
+	def get_data(self, model):
+		result = model.get_items('a-created', None, None, 1000)
+		return dict((i.id, i.data) for i in result.items)
+
+	def add_items(self, model, count):
+		for n in range(count):
+			model.add('a', {'title': 'item number %d' % n, 'tags': ['news', 'sport'][:n % 3], 'n': n}, id=str(n), notify=False)
+
+	def test_mixed_records(self):
+		self.add_items(self.model, 2)
+		self.compressing.add('a', {'title': 'compressed'}, id='c', notify=False)
+		self.assertTrue(self.get_record('0').startswith('{'))
+		self.assertTrue(self.get_record('c').startswith('\x01'))
+		for model in (self.model, self.compressing):
+			data = self.get_data(model)
+			self.assertEqual(sorted(data.keys()), ['0', '1', 'c'])
+			self.assertEqual(data['c'], {'title': 'compressed'})
+			self.assertEqual(data['1']['n'], 1)
+
+	def test_dictionary(self):
+		writer = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix, item_compression=True)
+		self.add_items(writer, 200)
+		dict_id = self.compressing.train_item_dictionary('a', dict_size=4096)
+		self.assertNotEqual(dict_id, 0)
+
+		self.compressing.add('a', {'title': 'trained'}, id='t', notify=False)
+		frame = self.get_record('t')[1:]
+		self.assertEqual(smartfeed.zstandard.get_frame_parameters(frame).dict_id, dict_id)
+
+		# other processes check for a new dictionary now and then
+		writer.add('a', {'title': 'before'}, id='b', notify=False)
+		self.assertEqual(smartfeed.zstandard.get_frame_parameters(self.get_record('b')[1:]).dict_id, 0)
+		writer.zdict_current['a'] = (time.time() - 61, 0)
+		writer.add('a', {'title': 'after'}, id='p', notify=False)
+		self.assertEqual(smartfeed.zstandard.get_frame_parameters(self.get_record('p')[1:]).dict_id, dict_id)
+
+		# and load it to read
+		reader = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix)
+		data = self.get_data(reader)
+		self.assertEqual(len(data), 203)
+		self.assertEqual(data['t'], {'title': 'trained'})
+		self.assertEqual(data['p'], {'title': 'after'})
+		self.assertEqual(data['7']['title'], 'item number 7')
+
+	def test_migrate(self):
+		self.add_items(self.model, 10)
+		self.model.delete('a', '3', notify=False)
+		before = self.get_data(self.model)
+
+		cursor = 0
+		while True:
+			cursor, updated = self.compressing.migrate_items('a', cursor)
+			if cursor == 0:
+				break
+		for n in range(10):
+			self.assertTrue(self.get_record(str(n)).startswith('\x01'))
+		self.assertEqual(self.get_data(self.compressing), before)
+		self.assertEqual(self.compressing.migrate_items('a', 0, count=1000), (0, 0))
+
+class LargeFieldTest(ModelTestCase):
+	def setUp(self):
+		super(LargeFieldTest, self).setUp()
+		self.model = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix, large_field_size=20)
+		self.big = 'x' * 50
+
+	def get_fields(self):
+		return sorted(self.model.redis.hkeys(self.prefix + 'a-item-fields'))
+
+	def get_item(self, fields=None):
+		return self.model.get_items('a-created', None, None, 10, fields=fields).items[0]
+
+	def test_split(self):
+		self.model.add('a', {'title': 'small', 'body': self.big, 'extra': self.big}, id='1', notify=False)
+		self.assertEqual(self.get_fields(), ['1-body', '1-extra'])
+		self.assertEqual(json.loads(self.model.redis.hget(self.prefix + 'a-items', '1'))['data'], {'title': 'small'})
+		self.assertEqual(self.get_item().data, {'title': 'small', 'body': self.big, 'extra': self.big})
+		self.assertEqual(self.get_item(fields=['title']).data, {'title': 'small'})
+		self.assertEqual(self.get_item(fields=['body', 'missing']).data, {'body': self.big})
+
+	def test_stale_fields(self):
+		self.model.add('a', {'body': self.big, 'extra': self.big}, id='1', notify=False)
+		self.model.add('a', {'body': self.big, 'extra': 'small'}, id='1', notify=False)
+		self.assertEqual(self.get_fields(), ['1-body'])
+		self.assertEqual(self.get_item().data, {'body': self.big, 'extra': 'small'})
+		self.model.add('a', {'body': 'small'}, id='1', notify=False)
+		self.assertEqual(self.get_fields(), [])
+
+		self.model.add('a', {'body': self.big}, id='2', notify=False)
+		self.model.delete('a', '2', notify=False)
+		self.assertEqual(self.get_fields(), [])
+
+	def test_changed_while_read(self):
+		self.model.add('a', {'body': self.big}, id='1', notify=False)
+		writer = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix, large_field_size=20)
+		redis = self.model.redis
+		calls = list()
+		class ChangingRedis(object):
+			def __getattr__(self, name):
+				return getattr(redis, name)
+
+			# the record is replaced between reading it and its fields
+			def hmget(self, *args):
+				calls.append(args)
+				if len(calls) == 1:
+					writer.add('a', {'body': 'y' * 50}, id='1', notify=False)
+				return redis.hmget(*args)
+
+		self.model.redis = ChangingRedis()
+		self.assertEqual(self.get_item().data, {'body': 'y' * 50})
+		self.assertEqual(len(calls), 2)
+
+class RecordingPublisher(smartfeed.Publisher):
+	def __init__(self):
+		self.published = list()
+
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		self.published.append((feed_id, item.id, cursor))
+
+class LegacyNotifyTest(ModelTestCase):
+	def setUp(self):
+		super(LegacyNotifyTest, self).setUp()
+		self.model.publisher = RecordingPublisher()
+
+	# as queued by earlier versions
+	def queue_legacy(self, id, state, created):
+		props = {'id': id, 'state': state, 'created': created, 'item': {'meta': {'id': 'item-' + id, 'created': created, 'modified': created}, 'data': {}}, 'cursor_created': '%d_0_1' % created}
+		self.model.redis.rpush(self.prefix + 'a-notify', id)
+		self.model.redis.hset(self.prefix + 'a-notify-items', id, json.dumps(props))
+
+	def test_drain_once(self):
+		now = int(time.time())
+		self.queue_legacy('1', 'pending', now)
+		self.queue_legacy('2', 'initializing', now - 120)
+		self.assertEqual(self.model.recover_notify('a'), 1)
+		self.assertEqual(self.model.publisher.published, [('a-created', 'item-1', '%d_0_1' % now)])
+		self.assertFalse(self.model.redis.exists(self.prefix + 'a-notify'))
+		self.assertFalse(self.model.redis.exists(self.prefix + 'a-notify-items'))
+
+		# the base is done, so later entries are left alone
+		self.queue_legacy('3', 'pending', now)
+		self.assertEqual(self.model.recover_notify('a'), 0)
+		self.assertTrue(self.model.redis.exists(self.prefix + 'a-notify'))
+
+	def test_recent_initializing_waits(self):
+		now = int(time.time())
+		self.queue_legacy('1', 'initializing', now)
+		self.assertEqual(self.model.recover_notify('a'), 0)
+		self.assertEqual(self.model.redis.llen(self.prefix + 'a-notify'), 1)
+
+		# its writer finishes
+		props = json.loads(self.model.redis.hget(self.prefix + 'a-notify-items', '1'))
+		props['state'] = 'pending'
+		self.model.redis.hset(self.prefix + 'a-notify-items', '1', json.dumps(props))
+		self.assertEqual(self.model.recover_notify('a'), 1)
+
+class ChainPublisher(smartfeed.Publisher):
+	def __init__(self, delay=0):
+		self.delay = delay
+		self.lock = threading.Lock()
+		self.published = list()
+
+	def publish(self, feed_id, item, total, cursor, prev_cursor, deleted_total=None):
+		time.sleep(self.delay)
+		with self.lock:
+			self.published.append((feed_id, item.id, cursor, prev_cursor))
+
+	def get_feed(self, feed_id):
+		return [p for p in self.published if p[0] == feed_id]
+
+class NotifyStreamTest(ModelTestCase):
+	def setUp(self):
+		super(NotifyStreamTest, self).setUp()
+		self.model.publisher = ChainPublisher()
+		self.key_notify = self.prefix + 'a-notify-stream'
+
+	def test_concurrent_writers_publish_in_order(self):
+		self.model.publisher.delay = 0.005
+		def write(n):
+			model = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=self.prefix)
+			model.publisher = self.model.publisher
+			for i in range(10):
+				model.add('a', {'n': i}, id='%d-%d' % (n, i))
+		threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		published = self.model.publisher.get_feed('a-created')
+		self.assertEqual(len(published), 40)
+		# each publish follows on from the one before
+		for prev, cur in zip(published, published[1:]):
+			self.assertEqual(cur[3], prev[2])
+		self.assertEqual(self.model.get_notify_lag('a'), 0)
+		self.assertEqual(self.model.get_notify_bases(), (0, []))
+
+	def test_held_lock_leaves_publishing(self):
+		self.model.inline_notify = False
+		self.model.add('a', {}, id='1')
+		self.model.redis.set(self.prefix + 'a-notify-lock', 'other')
+		self.assertEqual(self.model.process_notify('a'), 0)
+		self.assertEqual(self.model.get_notify_bases(), (0, ['a']))
+		self.model.redis.delete(self.prefix + 'a-notify-lock')
+		worker = smartfeed.RedisNotifyWorker(self.model)
+		self.assertEqual(worker.process_once(), 1)
+		self.assertEqual(self.model.get_notify_bases(), (0, []))
+		self.assertEqual(worker.process_once(), 0)
+
+	def test_recover_from_dead_consumer(self):
+		self.model.inline_notify = False
+		self.model.add('a', {}, id='1')
+		self.model.add('a', {}, id='2')
+		# a publisher reads the first entry, then dies holding the lock
+		self.model.redis.execute_command('XGROUP', 'CREATE', self.key_notify, 'publishers', '0')
+		self.model.redis.execute_command('XREADGROUP', 'GROUP', 'publishers', 'dead', 'COUNT', 1, 'STREAMS', self.key_notify, '>')
+		self.model.redis.set(self.prefix + 'a-notify-lock', 'dead', px=200)
+		self.model.add('a', {}, id='3')
+
+		self.assertEqual(self.model.process_notify('a'), 0)
+		time.sleep(0.3)
+		self.assertEqual(self.model.process_notify('a'), 3)
+		published = self.model.publisher.get_feed('a-created')
+		self.assertEqual([p[1] for p in published], ['1', '2', '3'])
+		for prev, cur in zip(published, published[1:]):
+			self.assertEqual(cur[3], prev[2])
+		self.assertEqual(self.model.redis.execute_command('XPENDING', self.key_notify, 'publishers')[0], 0)
+		self.assertEqual(self.model.get_notify_lag('a'), 0)
+
+class LiveTest(ModelTestCase):
+	def setUp(self):
+		super(LiveTest, self).setUp()
+		self.model.publisher = ChainPublisher()
+
+	def test_live_index(self):
+		for id in ('1', '2', '3'):
+			self.model.add('a', {'text': 'item ' + id}, id=id)
+		self.model.delete('a', '2')
+		result = self.model.get_items('a-live', None, None, 10)
+		self.assertEqual([i.id for i in result.items], ['1', '3'])
+
+		# the tombstone keeps only the id and timestamps
+		result = self.model.get_items('a-created', None, None, 10)
+		self.assertEqual([(i.id, i.deleted, i.data) for i in result.items], [('1', False, {'text': 'item 1'}), ('2', True, None), ('3', False, {'text': 'item 3'})])
+		self.assertIsNone(json.loads(self.model.redis.hget(self.prefix + 'a-items', '2'))['data'])
+
+	def test_delete_publishes_on_live(self):
+		self.model.add('a', {}, id='1')
+		self.model.add('a', {}, id='2')
+		head = self.model.redis.get(self.prefix + 'a-lastpub-live')
+		self.model.delete('a', '1')
+		published = self.model.publisher.get_feed('a-live')
+		self.assertEqual([p[1] for p in published], ['1', '2', '1'])
+		# published at the head, which stays put
+		self.assertEqual(published[2][2:], (head, head))
+		self.assertTrue(self.model.is_head('a-live', head))
+
+		# nothing to publish for items not in the live index
+		self.model.redis.zrem(self.prefix + 'a-index-live', '2')
+		self.model.delete('a', '2')
+		self.assertEqual(len(self.model.publisher.get_feed('a-live')), 3)
+
+class MoverTest(ModelTestCase):
+	def make_model(self, prefix):
+		model = smartfeed.RedisModel(host='localhost', port=6379, db=0, prefix=prefix, filters={'tag': lambda data: data.get('tag')}, inline_notify=False, large_field_size=20)
+		model.publisher = smartfeed.Publisher()
+		return model
+
+	# return the keys under the prefix by name, with their values
+	def dump(self, prefix):
+		out = dict()
+		r = self.model.redis
+		for key in r.keys(prefix + '*'):
+			t = r.type(key)
+			if t == 'hash':
+				value = r.hgetall(key)
+			elif t == 'zset':
+				value = r.zrange(key, 0, -1, withscores=True)
+			elif t == 'set':
+				value = r.smembers(key)
+			elif t == 'string':
+				value = r.get(key)
+			else:
+				continue
+			out[key[len(prefix):]] = value
+		return out
+
+	def get_notify(self, prefix):
+		return [e[1] for e in self.model.redis.execute_command('XRANGE', prefix + 'a-notify-stream', '-', '+')]
+
+	def test_move(self):
+		source = self.make_model(self.prefix)
+		dest = self.make_model(self.prefix + 'dest-')
+		big = 'x' * 50
+		for n in range(1, 7):
+			source.add('a', {'tag': 't%d' % (n % 2), 'body': big if n % 2 else 'small'}, id=str(n))
+		source.delete('a', '1')
+		source.psh_sub_set('a-created', 'http://example.com/1')
+		source.psh_sub_set('a-modified', 'http://example.com/2')
+
+		mover = smartfeed.RedisBaseMover(source, dest, 'a', chunk_size=2)
+		mover.copy()
+
+		# meanwhile
+		source.add('a', {'tag': 'other', 'body': 'small'}, id='3')
+		source.delete('a', '5')
+		source.add('a', {'tag': 't1', 'body': big}, id='7')
+		source.redis.zadd(self.prefix + 'a-index-deleted', '1', 1000)
+		self.assertEqual(source.clear_expired('a', 60), 1)
+		source.psh_sub_remove('a-created', 'http://example.com/1')
+		source.psh_sub_set('a-live', 'http://example.com/3')
+		notify = self.get_notify(self.prefix)
+		self.assertTrue(len(notify) > 0)
+
+		mover.cutover()
+
+		moved = self.dump(self.prefix + 'a-')
+		self.assertEqual(moved.pop('moved'), '1')
+		self.assertEqual(self.dump(self.prefix + 'dest-a-'), moved)
+		self.assertEqual(self.dump(self.prefix + 'dest-psh-subs-'), self.dump(self.prefix + 'psh-subs-'))
+		self.assertEqual(self.get_notify(self.prefix + 'dest-'), notify)
+		self.assertEqual(self.get_notify(self.prefix), [])
+		self.assertEqual(dest.get_notify_bases(), (0, ['a']))
+		self.assertEqual(source.get_notify_bases(), (0, []))
+
+		# what happened meanwhile made it across
+		self.assertEqual(sorted(moved['items'].keys()), ['2', '3', '4', '5', '6', '7'])
+		self.assertEqual(sorted(moved['item-fields'].keys()), ['7-body'])
+		self.assertEqual(moved['filter-tag-other'], set(['3']))
+		self.assertEqual(sorted(dest.get_psh_subs('a-live')[1]), ['http://example.com/3'])
+		self.assertEqual(dest.get_psh_subs('a-created')[1], [])
+
+		self.assertRaises(smartfeed.BaseMovedError, source.add, 'a', {}, id='8')
+		self.assertRaises(smartfeed.BaseMovedError, source.delete, 'a', '2')
+
+		mover.purge()
+		self.assertEqual(self.dump(self.prefix + 'a-'), {'moved': '1'})
+		self.assertEqual(self.dump(self.prefix + 'psh-subs-'), {})
+		self.assertEqual(self.dump(self.prefix + 'dest-a-'), moved)
+		result = dest.get_items('a-created', None, None, 10)
+		self.assertEqual([(i.id, i.deleted) for i in result.items], [('2', False), ('3', False), ('4', False), ('5', True), ('6', False), ('7', False)])
+		self.assertEqual(result.items[5].data['body'], big)
+
+class WebhookTest(ModelTestCase):
+	def setUp(self):
+		super(WebhookTest, self).setUp()
+		self.lock = threading.Lock()
+		self.requests = list()
+		self.callback = StandIn(self.handle)
+		self.deliverer = smartfeed.WebhookDeliverer(workers=2, backoff=0.01, allowed_hosts=['127.0.0.1'])
+		self.model.publisher = smartfeed.PshPublisher(self.model, deliverer=self.deliverer, formatter=smartfeed.DefaultFormatter())
+
+	def tearDown(self):
+		self.callback.close()
+
+	# the callback confirms with the challenge, except under /wrong. posts
+	#   to /flaky fail the first time, and posts to /slow take a while
+	def handle(self, method, path, body):
+		with self.lock:
+			self.requests.append((method, path, body))
+			count = len([r for r in self.requests if r[1] == path])
+		if method == 'GET':
+			if path.startswith('/wrong'):
+				return (200, 'wrong')
+			params = urlparse.parse_qs(urlparse.urlsplit(path).query)
+			return (200, params['hub.challenge'][0])
+		if path == '/flaky' and count == 1:
+			return (500, '')
+		if path == '/slow':
+			time.sleep(0.5)
+		return (204, '')
+
+	def subscribe(self, deliverer, uri):
+		return deliverer.verify(uri, 'subscribe', 'http://example.com/a/', lambda: self.model.psh_sub_set('a-created', uri))
+
+	def test_verify_and_deliver(self):
+		uri = self.callback.uri + '/hook?x=1'
+		self.assertTrue(self.subscribe(self.deliverer, uri))
+		self.assertTrue(self.deliverer.flush(5))
+		self.assertEqual(list(self.model.iter_psh_subs('a-created')), [uri])
+		method, path, body = self.requests[0]
+		self.assertEqual(method, 'GET')
+		params = urlparse.parse_qs(urlparse.urlsplit(path).query)
+		self.assertEqual(params['x'], ['1'])
+		self.assertEqual(params['hub.mode'], ['subscribe'])
+		self.assertEqual(params['hub.topic'], ['http://example.com/a/'])
+
+		self.model.add('a', {'n': 1}, id='1')
+		self.assertTrue(self.deliverer.flush(5))
+		posts = [r for r in self.requests if r[0] == 'POST']
+		self.assertEqual(len(posts), 1)
+		self.assertEqual(posts[0][1], '/hook?x=1')
+		self.assertEqual([i['id'] for i in json.loads(posts[0][2])['items']], ['1'])
+
+	def test_verify_wrong_challenge(self):
+		self.subscribe(self.deliverer, self.callback.uri + '/wrong')
+		self.assertTrue(self.deliverer.flush(5))
+		self.assertEqual(len(self.requests), 1)
+		self.assertEqual(list(self.model.iter_psh_subs('a-created')), [])
+
+	def test_private_host(self):
+		deliverer = smartfeed.WebhookDeliverer(workers=1)
+		self.subscribe(deliverer, self.callback.uri + '/hook')
+		deliverer.deliver(self.callback.uri + '/hook', {}, 'body')
+		self.assertTrue(deliverer.flush(5))
+		self.assertEqual(self.requests, [])
+		self.assertEqual(deliverer.failed, 2)
+		self.assertEqual(list(self.model.iter_psh_subs('a-created')), [])
+
+	def test_retry(self):
+		self.deliverer.deliver(self.callback.uri + '/flaky', {'Content-Type': 'text/plain'}, 'body')
+		self.assertTrue(self.deliverer.flush(5))
+		self.assertEqual([r[1] for r in self.requests], ['/flaky', '/flaky'])
+		self.assertEqual((self.deliverer.delivered, self.deliverer.failed), (1, 0))
+
+	def test_max_pending(self):
+		deliverer = smartfeed.WebhookDeliverer(workers=1, allowed_hosts=['127.0.0.1'], max_pending=1)
+		self.assertTrue(deliverer.deliver(self.callback.uri + '/slow', {}, 'body'))
+		self.assertFalse(deliverer.deliver(self.callback.uri + '/slow', {}, 'body'))
+		self.assertTrue(deliverer.flush(5))
+		self.assertTrue(deliverer.deliver(self.callback.uri + '/slow', {}, 'body'))
+		self.assertTrue(deliverer.flush(5))
+		self.assertEqual((deliverer.delivered, deliverer.dropped), (2, 1))
+
+	def test_subscriptions_view(self):
+		from django.test.client import RequestFactory
+		from smartfeed.django.app import views
+		uri = self.callback.uri + '/hook'
+		req = RequestFactory().post('/subscriptions/', {'hub.mode': 'subscribe', 'hub.callback': uri})
+		self.assertEqual(views.subscriptions(req, base='a').status_code, 202)
+		self.assertTrue(smartfeed.django.get_webhook_deliverer().flush(5))
+		self.assertEqual(list(self.model.iter_psh_subs('a-created')), [uri])
+
+		req = RequestFactory().post('/subscriptions/', {'hub.mode': 'subscribe', 'hub.callback': 'file:///etc/passwd'})
+		self.assertEqual(views.subscriptions(req, base='a').status_code, 400)
+
+class ViewTest(ModelTestCase):
+	def setUp(self):
+		super(ViewTest, self).setUp()
+		from django.test.client import RequestFactory
+		from smartfeed.django.app import views
+		self.rf = RequestFactory()
+		self.views = views
+		self.view_model = smartfeed.django.get_default_model()
+		self.queried = list()
+		get_items = self.view_model.get_items
+		def record_get_items(*args, **kwargs):
+			self.queried.append(args[0])
+			return get_items(*args, **kwargs)
+		self.view_model.get_items = record_get_items
+
+	def tearDown(self):
+		del self.view_model.get_items
+
+	def get(self, view, params, **headers):
+		import jwt
+		grip_sig = jwt.encode({'iss': 'check', 'exp': int(time.time()) + 3600}, 'check')
+		req = self.rf.get('/', params, HTTP_GRIP_SIG=grip_sig, **headers)
+		return view(req, base='a')
+
+	def get_cursors(self, ids):
+		for id in ids:
+			self.model.add('a', {}, id=id, notify=False)
+		return self.model.get_items('a-created', None, None, len(ids), cursors=True).cursors
+
+	def test_sse_replay(self):
+		cursors = self.get_cursors(['1', '2', '3'])
+		resp = self.get(self.views.stream, {}, HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID=cursors[0])
+		self.assertEqual(resp['Content-Type'], 'application/grip-instruct')
+		instruct = json.loads(resp.content)
+		body = instruct['response']['body']
+		self.assertEqual([l[4:] for l in body.split('\n') if l.startswith('id: ')], cursors[1:])
+		# the hold continues from the last replayed event
+		self.assertEqual(instruct['hold']['channels'][0]['prev-id'], cursors[2])
+
+		resp = self.get(self.views.stream, {'lastEventId': cursors[2]}, HTTP_ACCEPT='text/event-stream')
+		instruct = json.loads(resp.content)
+		self.assertNotIn('body', instruct['response'])
+		self.assertEqual(instruct['hold']['channels'][0]['prev-id'], cursors[2])
+
+		resp = self.get(self.views.stream, {}, HTTP_ACCEPT='text/event-stream')
+		self.assertNotIn('prev-id', json.loads(resp.content)['hold']['channels'][0])
+
+	def test_sse_descending(self):
+		resp = self.get(self.views.stream, {'order': '-created'}, HTTP_ACCEPT='text/event-stream')
+		self.assertEqual(resp.status_code, 400)
+
+	def test_head_hold(self):
+		cursors = self.get_cursors(['1', '2'])
+		resp = self.get(self.views.items, {'since': 'cursor:' + cursors[1], 'wait': 'true'})
+		self.assertEqual(resp['Content-Type'], 'application/grip-instruct')
+		self.assertEqual(json.loads(resp.content)['hold']['channels'][0]['prev-id'], cursors[1])
+		self.assertEqual(self.queried, [])
+
+	def test_behind_head_queries(self):
+		cursors = self.get_cursors(['1', '2'])
+		resp = self.get(self.views.items, {'since': 'cursor:' + cursors[0], 'wait': 'true'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual([i['id'] for i in json.loads(resp.content)['items']], ['2'])
+		self.assertEqual(self.queried, ['a-created'])
+
+		# with no record of the head, the query decides
+		self.model.redis.delete(self.prefix + 'a-lastpub-created')
+		resp = self.get(self.views.items, {'since': 'cursor:' + cursors[1], 'wait': 'true'})
+		self.assertEqual(resp['Content-Type'], 'application/grip-instruct')
+		self.assertEqual(json.loads(resp.content)['hold']['channels'][0]['prev-id'], cursors[1])
+		self.assertEqual(self.queried, ['a-created', 'a-created'])
+
+	# a write lands between the query and the hold
+	def write_after(self, name):
+		f = getattr(self.view_model, name)
+		def write_after(*args, **kwargs):
+			out = f(*args, **kwargs)
+			self.model.add('a', {}, id='late', notify=False)
+			return out
+		setattr(self.view_model, name, write_after)
+
+	def test_batch_hold(self):
+		import jwt
+		cursors = self.get_cursors(['1'])
+		grip_sig = jwt.encode({'iss': 'check', 'exp': int(time.time()) + 3600}, 'check')
+		body = json.dumps({'feeds': [{'base': 'a', 'since': 'cursor:' + cursors[0]}], 'wait': True})
+		req = self.rf.post('/batch/', body, content_type='application/json', HTTP_GRIP_SIG=grip_sig)
+		self.assertEqual(self.views.batch(req, base='a')['Content-Type'], 'application/grip-instruct')
+
+		self.write_after('get_items_batch')
+		try:
+			resp = self.views.batch(req, base='a')
+		finally:
+			del self.view_model.get_items_batch
+		self.assertEqual(resp['Content-Type'], 'application/json')
+
+	def test_fields(self):
+		big = 'x' * 200
+		self.view_model.add('a', {'title': 'one', 'body': big}, id='1', notify=False)
+		self.assertEqual(self.model.redis.hkeys(self.prefix + 'a-item-fields'), ['1-body'])
+		for fields, data in (('title', {'title': 'one'}), ('body', {'body': big}), ('title,body', {'title': 'one', 'body': big})):
+			resp = self.get(self.views.items, {'fields': fields})
+			self.assertEqual(resp.status_code, 200)
+			items = json.loads(resp.content)['items']
+			self.assertEqual([dict((k, v) for k, v in i.items() if k not in ('id', 'created', 'modified')) for i in items], [data])
+
+	def test_fields_hold(self):
+		cursors = self.get_cursors(['1'])
+		params = {'since': 'cursor:' + cursors[0], 'wait': 'true', 'fields': 'x'}
+		resp = self.get(self.views.items, params)
+		self.assertEqual(resp['Content-Type'], 'application/grip-instruct')
+
+		# it is found at the head without a query
+		self.write_after('is_head')
+		try:
+			resp = self.get(self.views.items, params)
+		finally:
+			del self.view_model.is_head
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(json.loads(resp.content)['last_cursor'], cursors[0])
+
+class PublisherTest(unittest.TestCase):
+	def test_publish_without_deleted_total(self):
+		published = list()
+		class OldPublisher(smartfeed.Publisher):
+			def publish(self, feed_id, item, total, cursor, prev_cursor):
+				published.append((feed_id, cursor))
+
+		model = smartfeed.Model(publisher=smartfeed.PublisherSet([OldPublisher()]))
+		model.notify('a-created', smartfeed.Item(), 1, '1000_0_1', None)
+		model.publisher.publish_items('a-created', [smartfeed.Item(), smartfeed.Item()], 2, ['1000_1_2', '1000_2_3'], '1000_0_1')
+		self.assertEqual(published, [('a-created', '1000_0_1'), ('a-created', '1000_1_2'), ('a-created', '1000_2_3')])
+
+class BatchPublisher(smartfeed.Publisher):
+	def __init__(self):
+		self.published = list()
+
+	def publish_items(self, feed_id, items, total, cursors, prev_cursor, deleted_total=None):
+		self.published.append((feed_id, cursors, prev_cursor))
+
+class CoalescingPublisherTest(unittest.TestCase):
+	def setUp(self):
+		self.target = BatchPublisher()
+
+	def publish_chain(self, publisher, feed_id, cursors, prev_cursor):
+		for cursor in cursors:
+			publisher.publish(feed_id, smartfeed.Item(), 1, cursor, prev_cursor)
+			prev_cursor = cursor
+
+	def test_chain_break(self):
+		publisher = smartfeed.CoalescingPublisher(self.target, window=10)
+		self.publish_chain(publisher, 'a-created', ['1', '2'], None)
+		self.assertEqual(self.target.published, [])
+		# 3 was never seen, so 4 starts another batch
+		self.publish_chain(publisher, 'a-created', ['4'], '3')
+		self.assertEqual(self.target.published, [('a-created', ['1', '2'], None)])
+		publisher.flush()
+		self.assertEqual(self.target.published[1:], [('a-created', ['4'], '3')])
+
+	def test_max_items(self):
+		publisher = smartfeed.CoalescingPublisher(self.target, window=10, max_items=3)
+		self.publish_chain(publisher, 'a-created', ['1', '2', '3', '4'], None)
+		self.assertEqual(self.target.published, [('a-created', ['1', '2', '3'], None)])
+		publisher.flush()
+		self.assertEqual(self.target.published[1:], [('a-created', ['4'], '3')])
+
+	def test_window(self):
+		publisher = smartfeed.CoalescingPublisher(self.target, window=0.05)
+		threads = threading.active_count()
+		for n in range(20):
+			self.publish_chain(publisher, 'f%d-created' % n, ['1', '2'], None)
+		# one thread publishes every feed
+		self.assertEqual(threading.active_count(), threads + 1)
+		self.assertEqual(self.target.published, [])
+		end = time.time() + 5
+		while len(self.target.published) < 20 and time.time() < end:
+			time.sleep(0.01)
+		self.assertEqual(sorted(self.target.published), sorted(('f%d-created' % n, ['1', '2'], None) for n in range(20)))
+
+		# and keeps going
+		self.publish_chain(publisher, 'a-created', ['1'], None)
+		end = time.time() + 5
+		while len(self.target.published) < 21 and time.time() < end:
+			time.sleep(0.01)
+		self.assertEqual(self.target.published[20:], [('a-created', ['1'], None)])
+
+class OldPublisherTest(ModelTestCase):
+	def test_redis_model_with_old_publisher(self):
+		published = list()
+		class OldPublisher(smartfeed.Publisher):
+			def publish(self, feed_id, item, total, cursor, prev_cursor):
+				published.append((feed_id, item.id, total))
+
+		self.model.publisher = OldPublisher()
+		self.model.add('a', {'n': 1}, id='1')
+		self.assertEqual(sorted(published), [('a-created', '1', 1), ('a-live', '1', 1), ('a-modified', '1', 1)])
+
+# counts its instances
+class SlowLoad(object):
+	lock = threading.Lock()
+	count = 0
+
+	def __init__(self):
+		time.sleep(0.1)
+		with SlowLoad.lock:
+			SlowLoad.count += 1
+
+class GetClassTest(unittest.TestCase):
+	def test_shared_by_threads(self):
+		import smartfeed.django
+		# as in a new process
+		smartfeed.django.loaded_pid = None
+		out = list()
+		threads = list()
+		for n in range(8):
+			threads.append(threading.Thread(target=lambda: out.append(smartfeed.django.get_class('__main__.SlowLoad'))))
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(SlowLoad.count, 1)
+		self.assertEqual(len(set(id(c) for c in out)), 1)
+
+class ChannelTrackerTest(unittest.TestCase):
+	def test_sources(self):
+		tracker = smartfeed.ChannelTracker()
+		tracker.started = 0
+		tracker.update('c', 1, source=('pushpin1', 'response'))
+		tracker.update('c', 1, source=('pushpin1', 'stream'))
+		tracker.update('c', 1, source=('pushpin2', 'response'))
+		tracker.update('c', 0, source=('pushpin1', 'response'))
+		tracker.update('c', 0, source=('pushpin2', 'response'))
+		self.assertTrue(tracker.is_subscribed('c'))
+		tracker.update('c', 0, source=('pushpin1', 'stream'))
+		self.assertFalse(tracker.is_subscribed('c'))
+
+	def test_expiry(self):
+		tracker = smartfeed.ChannelTracker()
+		tracker.started = 0
+		tracker.update('c', 1, ttl=-1, source='a')
+		tracker.update('c', 1, source='b')
+		self.assertTrue(tracker.is_subscribed('c'))
+		tracker.update('c', 0, source='b')
+		self.assertFalse(tracker.is_subscribed('c'))
+
+class EpcpPublisherTest(unittest.TestCase):
+	def setUp(self):
+		self.published = list()
+		test = self
+		class Pub(object):
+			def publish(self, channel, item):
+				test.published.append((channel, item.id, item.prev_id))
+		self.tracker = smartfeed.ChannelTracker()
+		self.tracker.started = 0
+		self.publisher = smartfeed.EpcpPublisher(Pub(), formatter=smartfeed.DefaultFormatter(), tracker=self.tracker, grace=0.2)
+		self.channel = smartfeed.get_channel('', 'a-created', 'json')
+
+	def publish(self, cursor, prev_cursor):
+		item = smartfeed.Item()
+		item.id = cursor
+		item.created = item.modified = datetime.utcnow()
+		item.data = {}
+		self.publisher.publish('a-created', item, 1, cursor, prev_cursor)
+
+	def test_replay_on_report(self):
+		self.publish('1', None)
+		self.publish('2', '1')
+		self.assertEqual(self.published, [])
+		# a client held just before these, and is now reported
+		self.tracker.update(self.channel, 1)
+		self.assertEqual(self.published, [(self.channel, '1', None), (self.channel, '2', '1')])
+		self.publish('3', '2')
+		self.assertEqual(self.published[2:], [(self.channel, '3', '2')])
+		# other channels of the feed are still skipped
+		self.assertEqual(set(c for c, i, p in self.published), set([self.channel]))
+
+	def test_skipped_go_first(self):
+		self.publish('1', None)
+		# reported without the listener seeing it yet
+		self.tracker.channels[self.channel] = {None: time.time() + 60}
+		self.publish('2', '1')
+		self.assertEqual(self.published, [(self.channel, '1', None), (self.channel, '2', '1')])
+
+	def test_grace_expires(self):
+		self.publish('1', None)
+		time.sleep(0.3)
+		self.tracker.update(self.channel, 1)
+		self.assertEqual(self.published, [])
+
+class PubControlSetTest(unittest.TestCase):
+	def test_channel_workers(self):
+		published = list()
+		class Pub(object):
+			def __init__(self, n):
+				self.n = n
+
+			def publish_async(self, channel, item):
+				published.append((self.n, channel))
+
+			def finish(self):
+				pass
+
+		pcs = smartfeed.PubControlSet()
+		pcs.pubs.append([Pub(0), Pub(1), Pub(2)])
+		channels = ['smartfeed-a-json', 'smartfeed-b-json', u'smartfeed-\xe9-json', u'smartfeed-\u6f22-json']
+		for channel in channels * 2:
+			pcs.publish(channel, None)
+		# each channel always goes through the same instance
+		self.assertEqual(published[:len(channels)], published[len(channels):])
+
+def check(args):
+	from django.conf import settings
+	if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+		settings.configure()
+
+	# views use a model under the checks' prefix
+	settings.SMARTFEED_MODEL_CLASS = 'smartfeed.django.RedisModel'
+	settings.SMARTFEED_REDIS_PREFIX = ModelTestCase.prefix
+	settings.SMARTFEED_PSH_ALLOWED_HOSTS = ['127.0.0.1']
+	settings.SMARTFEED_REDIS_LARGE_FIELD_SIZE = 100
+	# a proxy that holds requests, with nowhere to publish
+	settings.GRIP_PROXIES = [{'key': 'check'}]
+	settings.ALLOWED_HOSTS = ['*']
+	import smartfeed.django
+
+	unittest.main(argv=['test.py check'] + args)
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		usage()
+	if sys.argv[1] == 'load':
+		load(sys.argv[2:])
+	elif sys.argv[1] == 'check':
+		check(sys.argv[2:])
+	else:
+		run_command(sys.argv[1:])